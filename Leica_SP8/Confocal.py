@@ -9,6 +9,8 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 """
 
 from bleedthrough import *
+from roi_measure import save_rois, load_rois
+from measurement_table import measurementTable
 import tifffile
 import os
 import shutil
@@ -40,6 +42,11 @@ G = 2.845178   # if 0 then no Eapp calculation
 
 MeasureROIs = False
 MeasureRaw = False
+# measurement tables: None for parquet (if pyarrow is installed) or npz, or 'feather', 'npz', 'csv'
+OutputFormat = None
+# ROI sets saved by an earlier run (bg_rois.npz, cell_rois.npz in its folder), None to draw the ROIs
+BgRoiFile = None
+CellRoiFile = None
 
 ######################### Don't change after this line
 
@@ -56,7 +63,11 @@ print('current folder:', newdir)
 shutil.copy(path, newdir)
 
 # Define ROIs for the background
-bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+if BgRoiFile:
+    bg_rois = load_rois(os.path.join(wkdir, BgRoiFile))
+else:
+    bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+save_rois("bg_rois.npz", bg_rois)
 bg_list = get_intensity_list(bg_rois, rawImg)
 try:
     bg_mean = np.mean(bg_list, axis=1)
@@ -97,7 +108,11 @@ corrImg = corrImg.astype('uint16')
 tifffile.imwrite("corrected.tiff", corrImg, metadata={'axes': 'CYX'})
 
 if MeasureROIs:
-    cell_rois = draw_roi2(corrImg)
+    if CellRoiFile:
+        cell_rois = load_rois(os.path.join(wkdir, CellRoiFile))
+    else:
+        cell_rois = draw_roi2(corrImg)
+    save_rois("cell_rois.npz", cell_rois)
     if CalcRatio:
         ratio_list = [RatioImg]
         if CalcEapp:
@@ -113,7 +128,7 @@ if MeasureROIs:
     show_all_channels_with_roi(allImg, cell_rois)
     OutTable = cell_list.transpose((1, 0))
     print("corrected ROIs:\n", OutTable)
-    np.savetxt("measurements.csv", OutTable, delimiter=",")
+    measurementTable().add(OutTable, file=os.path.basename(path)).write("measurements", OutputFormat)
 else:
     show_all_channels2(corrImg, "Corrected images")
 
@@ -122,6 +137,7 @@ if MeasureRaw:
     RawTable = raw_list.transpose((1, 0))
     RawTable = np.vstack((bg_mean, RawTable))
     print("uncorrected ROIs:\n", RawTable)
-    np.savetxt("raw.csv", RawTable, delimiter=",")
+    raw_table = measurementTable().add(np.reshape(bg_mean, (1, -1)), 'background', file=os.path.basename(path), roi=0)
+    raw_table.add(raw_list.transpose((1, 0)), file=os.path.basename(path)).write("raw", OutputFormat)
 
 os.chdir(wkdir)
\ No newline at end of file
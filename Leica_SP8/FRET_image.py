@@ -9,6 +9,9 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 """
 
 from bleedthrough import *
+from roi_measure import save_rois
+from background import estimate_background
+from measurement_table import measurementTable
 import tifffile
 import os
 import shutil
@@ -28,11 +31,18 @@ CFPIndex = 0  # first channel
 FRETIndex = 1  # second channel
 
 G = 2.845178   # if 0 then no Eapp calculation
+# True: exact linear unmixing with the inverse of the mixing matrix, False: first-order bleed-through subtraction
+Unmix = False
+
+# Background: None to draw background ROIs, or 'percentile', 'mode' or 'otsu' to estimate it
+AutoBackground = None
 
 # Measure ROIs
 
 MeasureROIs = True
 MeasureRaw = True
+# measurement tables: None for parquet (if pyarrow is installed) or npz, or 'feather', 'npz', 'csv'
+OutputFormat = None
 
 ######################### Don't change after this line
 
@@ -49,20 +59,20 @@ print('current folder:', newdir)
 shutil.copy(path, newdir)
 
 # Define ROIs for the background
-bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
-bg_list = get_intensity_list(bg_rois, rawImg)
-try:
-    bg_mean = np.mean(bg_list, axis=1)
-except IndexError:
+if AutoBackground:
+    bg_list = estimate_background(rawImg, method=AutoBackground)
     bg_mean = bg_list
+else:
+    bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+    save_rois("bg_rois.npz", bg_rois, rawImg.shape[-2:])  # re-used by batch_FRET.py
+    bg_list = get_intensity_list(bg_rois, rawImg)
+    try:
+        bg_mean = np.mean(bg_list, axis=1)
+    except IndexError:
+        bg_mean = bg_list
 print("Background values are:\n", bg_list)
 print("Mean background values:\n", bg_mean)
 
-# subtract background for all channels
-newImg = subtract_background(rawImg, bg_mean)
-newImg[newImg < 0] = 0
-# show_all_channels_with_roi(newImg, bg_rois)
-
 # input bleed-though coefficient
 root = tk.Tk()
 if UsePrePara:
@@ -70,30 +80,27 @@ if UsePrePara:
 else:
     bt = BleedThroughChart(master=root, nrow=len(rawImg))
 root.mainloop()
-corrImg = subtract_bt(newImg, bt.array_all)
+# subtract background and bleed-through, calculate ratio and Eapp in one pass
+corrImg = np.empty(rawImg.shape, dtype='uint16')
+RatioImg = np.empty(rawImg.shape[1:], dtype='float32') if CalcRatio else None
+EappImg = np.empty(rawImg.shape[1:], dtype='float32') if CalcRatio and CalcEapp and G else None
+correct_fret(rawImg, bg_mean, bt.array_all, CFPIndex, FRETIndex, G, corrImg, RatioImg, EappImg, unmix=Unmix)
 if CalcRatio:
-    RatioImg = np.nan_to_num(np.true_divide(corrImg[FRETIndex], corrImg[CFPIndex]))
-    RatioImg[RatioImg < 0] = 0
-    RatioImg = RatioImg.astype('float32')
     tifffile.imwrite("ratio.tiff", RatioImg, metadata={'axes': 'YX'})
     if CalcEapp and G:
-        EappImg = np.nan_to_num(np.true_divide(RatioImg, RatioImg + G))
-        EappImg[EappImg < 0] = 0
-        EappImg = EappImg.astype('float32')
         tifffile.imwrite("Eapp.tiff", EappImg, metadata={'axes': 'YX'})
 
-corrImg[corrImg < 0] = 0
 # display corrected image
 
-corrImg = corrImg.astype('uint16')
 # tifffile.imwrite("corrected.tiff", corrImg, metadata={'axes': 'CXY'}, dtype='uint16')
 tifffile.imwrite("corrected.tiff", corrImg, metadata={'axes': 'CYX'})
 
 if MeasureROIs:
     cell_rois = draw_roi2(corrImg)
+    save_rois("cell_rois.npz", cell_rois, corrImg.shape[-2:])
     if CalcRatio:
         ratio_list = [RatioImg]
-        if CalcEapp:
+        if CalcEapp and G:
             ratio_list.append(EappImg)
         ratio_stack = np.stack(ratio_list).astype('float_')
         allImg = np.vstack((corrImg, ratio_stack))
@@ -106,7 +113,7 @@ if MeasureROIs:
     show_all_channels_with_roi(allImg, cell_rois)
     OutTable = cell_list.transpose((1, 0))
     print("corrected ROIs:\n", OutTable)
-    np.savetxt("measurements.csv", OutTable, delimiter=",")
+    measurementTable().add(OutTable, file=os.path.basename(path)).write("measurements", OutputFormat)
 else:
     show_all_channels2(corrImg, "Corrected images")
 
@@ -115,6 +122,7 @@ if MeasureRaw:
     RawTable = raw_list.transpose((1, 0))
     RawTable = np.vstack((bg_mean, RawTable))
     print("uncorrected ROIs:\n", RawTable)
-    np.savetxt("raw.csv", RawTable, delimiter=",")
+    raw_table = measurementTable().add(np.reshape(bg_mean, (1, -1)), 'background', file=os.path.basename(path), roi=0)
+    raw_table.add(raw_list.transpose((1, 0)), file=os.path.basename(path)).write("raw", OutputFormat)
 
 os.chdir(wkdir)
\ No newline at end of file
@@ -9,8 +9,12 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 """
 
 from SZmicroscopy import *
+from measurement_table import measurementTable
 import numpy as np
 
+# measurement tables: None for parquet (if pyarrow is installed) or npz, or 'feather', 'npz', 'csv'
+OutputFormat = None
+
 ################ Set tiff format
 
 # img_array = Read_1by1_TCYX(n_time=2, n_channel=3)          # for 1by1 reading
@@ -30,11 +34,11 @@ sub_bg_obj = subtract_background(img_obj, b)
 cell_roi = sub_bg_obj.draw_roi2(title="Please draw ROIs for the cells.")
 cell = sub_bg_obj.get_intensity_list(cell_roi, average_all_roi=False)
 
-cell_flat = np.concatenate((cell[:,:,0].T, cell[:,:,1].T, cell[:,:,2].T), axis=1)
-
+# mean of every cell and the background (roi 0); columns file, roi, t, channel, statistic, value
 file_path = tkFileDialog.asksaveasfilename()
-np.savetxt(file_path,
-           cell_flat, delimiter=",")
+table = measurementTable().add(cell, 'mean')
+table.add(b[np.newaxis], 'background', roi=0)
+table.write(file_path, OutputFormat)
 
 # ratio1 = np.nan_to_num(np.true_divide(sub_bg_obj.stack[:, 1], sub_bg_obj.stack[:, 0]))
 # ratio2 = np.nan_to_num(np.true_divide(sub_bg_obj.stack[:, 1], sub_bg_obj.stack[:, 2]))
@@ -9,9 +9,13 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 """
 
 from SZmicroscopy import *
+from measurement_table import measurementTable
 import numpy as np
 import os
 
+# measurement tables: None for parquet (if pyarrow is installed) or npz, or 'feather', 'npz', 'csv'
+OutputFormat = None
+
 ################ Set tiff format
 
 array_480 = Read_1by1_TCYX(n_time=2, n_channel=10)          # for 1by1 reading
@@ -31,12 +35,14 @@ img550_obj = imageStack(imgArray=array_550, meta='TCYX')
 ############ remove background
 bg_roi = img550_obj.draw_roi2(title="Please draw background.")
 
-bg480 = img480_obj.get_intensity_list(bg_roi, average_all_roi=True)
-noise480 = img480_obj.get_noise_list(bg_roi, average_all_roi=True)
+bg480_stat = img480_obj.measure(bg_roi, average_all_roi=True)   # mean and noise in one pass
+bg480 = bg480_stat['mean']
+noise480 = bg480_stat['std']
 sub_bg480_obj = subtract_background(img480_obj, bg480)
 
-bg550 = img550_obj.get_intensity_list(bg_roi, average_all_roi=True)
-noise550 = img550_obj.get_noise_list(bg_roi, average_all_roi=True)
+bg550_stat = img550_obj.measure(bg_roi, average_all_roi=True)
+bg550 = bg550_stat['mean']
+noise550 = bg550_stat['std']
 sub_bg550_obj = subtract_background(img550_obj, bg550)
 
 ############ measure cell ROIs
@@ -48,48 +54,16 @@ file_path = sub_bg480_obj.write_ome_tiff()
 sub_bg550_obj.write_ome_tiff(dtype='float32',
     file_path=file_path.split(".")[0] + "_550." + file_path.split(".")[1])
 
-cell480_flat = np.concatenate((cell480[:,0,:], cell480[:,1,:]), axis=1)
-cell550_flat = np.concatenate((cell550[:,0,:], cell550[:,1,:]), axis=1)
-
-np.savetxt(file_path.split(".")[0] + "_480" + ".csv",
-           cell480_flat, delimiter=",")
-
-
-np.savetxt(file_path.split(".")[0] + "_550" + ".csv",
-           cell550_flat, delimiter=",")
-
-bg480_flat = np.concatenate((bg480[0], bg480[1]))
-bg550_flat = np.concatenate((bg550[0], bg550[1]))
-noise480_flat = np.concatenate((noise480[0], noise480[1]))
-noise550_flat = np.concatenate((noise550[0], noise550[1]))
-
-sbr480 = cell480_flat.copy()
-sbr550 = cell550_flat.copy()
-snr480 = cell480_flat.copy()
-snr550 = cell550_flat.copy()
-
-for i in range(len(bg480_flat)):
-    sbr480[:, i] = cell480_flat[:, i] / bg480_flat[i]
-    snr480[:, i] = cell480_flat[:, i] / noise480_flat[i]
-
-for i in range(len(bg550_flat)):
-    sbr550[:, i] = cell550_flat[:, i] / bg550_flat[i]
-    snr550[:, i] = cell550_flat[:, i] / noise550_flat[i]
-
-np.savetxt(file_path.split(".")[0] + "_sbr480" + ".csv",
-           sbr480, delimiter=",")
-
-
-np.savetxt(file_path.split(".")[0] + "_sbr550" + ".csv",
-           sbr550, delimiter=",")
-
-
-np.savetxt(file_path.split(".")[0] + "_snr480" + ".csv",
-           snr480, delimiter=",")
-
-
-np.savetxt(file_path.split(".")[0] + "_snr550" + ".csv",
-           snr550, delimiter=",")
+# one table per excitation: mean, signal / background (sbr) and signal / noise (snr) of every cell,
+# plus background and noise (roi 0); columns file, roi, t, channel, statistic, value
+for (cell, bg, noise, suffix) in ((cell480, bg480, noise480, "_480"), (cell550, bg550, noise550, "_550")):
+    table = measurementTable()
+    table.add(cell, 'mean', file=os.path.basename(file_path))
+    table.add(cell / bg, 'sbr', file=os.path.basename(file_path))
+    table.add(cell / noise, 'snr', file=os.path.basename(file_path))
+    table.add(bg[np.newaxis], 'background', file=os.path.basename(file_path), roi=0)
+    table.add(noise[np.newaxis], 'noise', file=os.path.basename(file_path), roi=0)
+    table.write(file_path.split(".")[0] + suffix, OutputFormat)
 
 
 # tifffile.imwrite("corrected.tiff", corrImg, metadata={'axes': 'CYX'})
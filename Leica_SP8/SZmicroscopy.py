@@ -18,6 +18,86 @@ from math import ceil, sqrt
 import tifffile
 from matplotlib.widgets import Slider
 from scipy.stats import linregress
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from plane_cache import cached_load, CACHE_DIR
+from roi_measure import measure_rois, measure_labels, save_rois, load_rois, iter_measure_frames, \
+    measure_frames_to_csv
+from background import estimate_background, background_model
+from segmentation import segment_stack
+import glob
+import re
+import os
+import json
+
+
+class npyStore():
+    """
+    npyStore is an on-disk replacement for the ndarray in imageStack.stack, for stacks larger than RAM.
+    It is a directory with one .npy file per index of the first axis (one time point for 'TCYX'),
+    memory-mapped on access, so every imageStack method only touches one chunk at a time.
+    """
+
+    def __init__(self, path, shape=None, dtype=None, mode='r+'):
+        """
+        Open an existing store, or create a new one when shape is given.
+        :param path: directory of the store
+        :param shape: shape of the whole stack, e.g. (T, C, Y, X). Creates a zero-filled store.
+        :param dtype: dtype of the new store
+        :param mode: 'r+' to allow writing into the chunks, 'r' for read-only
+        """
+        self.path = path
+        self.mode = mode
+        if shape is not None:
+            os.makedirs(path, exist_ok=True)
+            self.shape = tuple(int(i) for i in shape)
+            self.dtype = np.dtype(dtype)
+            with open(os.path.join(path, 'store.json'), 'w') as fh:
+                json.dump({'shape': self.shape, 'dtype': self.dtype.str}, fh)
+            for i in range(self.shape[0]):
+                np.lib.format.open_memmap(self._chunk_path(i), mode='w+', dtype=self.dtype,
+                                          shape=self.shape[1:])
+        else:
+            with open(os.path.join(path, 'store.json')) as fh:
+                info = json.load(fh)
+            self.shape = tuple(info['shape'])
+            self.dtype = np.dtype(info['dtype'])
+        self.ndim = len(self.shape)
+
+    def _chunk_path(self, i):
+        return os.path.join(self.path, 'chunk_%06d.npy' % i)
+
+    def _chunk(self, i):
+        if i < 0:
+            i += self.shape[0]
+        return np.load(self._chunk_path(i), mmap_mode=self.mode)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self._chunk(i)
+
+    def __getitem__(self, key):
+        """
+        Index along the first axis. An integer returns the memory-mapped chunk (a view that can be
+        written into), a slice returns an in-memory copy of the selected chunks.
+        """
+        (first, rest) = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(first, slice):
+            return np.stack([self._chunk(i)[rest] for i in range(*first.indices(self.shape[0]))])
+        return self._chunk(first)[rest]
+
+    def __setitem__(self, key, value):
+        (first, rest) = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(first, slice):
+            for n, i in enumerate(range(*first.indices(self.shape[0]))):
+                self[(i,) + rest] = value[n]
+        else:
+            chunk = self._chunk(first)
+            chunk[rest] = value
+            chunk.flush()
 
 
 class imageStack():
@@ -28,9 +108,10 @@ class imageStack():
     def __init__(self, imgArray, meta, *a, **k):
         """
         Initiate an imageStack object.
-        :param imgArray: np.array, has to be built using a reader function.
+        :param imgArray: np.array, has to be built using a reader function, or an npyStore.
         :param meta: 'CYX': requires imgArray to be 3-dimensional.
                     'TCYX': 4-dimensional
+                    'TCZYX': 5-dimensional, z-stacks from `read_czi`
         """
         if meta == 'CYX':
             if len(imgArray.shape) == 3:
@@ -46,10 +127,29 @@ class imageStack():
                 (self.num_time, self.num_channel, self.num_y, self.num_x) = imgArray.shape
             else:
                 raise Exception("Dimension of imgArray not consistent with meta!")
+        if meta == 'TCZYX':
+            if len(imgArray.shape) == 5:
+                self.meta = meta
+                self.stack = imgArray
+                (self.num_time, self.num_channel, self.num_z, self.num_y, self.num_x) = imgArray.shape
+            else:
+                raise Exception("Dimension of imgArray not consistent with meta!")
 
     def __iter__(self):
         yield from self.stack
 
+    def float32_chunks(self, chunk_size=1):
+        """
+        Iterate over the stack as float32 working buffers, chunk by chunk along the first axis
+        (T for 'TCYX' and 'TCZYX', C for 'CYX'). The stack itself stays in its acquisition dtype
+        and only one chunk is converted at a time.
+        :param chunk_size: number of indices along the first axis in one chunk
+        :return: yields (slice, float32 np.array copy of the chunk)
+        """
+        for start in range(0, len(self.stack), chunk_size):
+            index = slice(start, start + chunk_size)
+            yield index, np.array(self.stack[index], dtype='float32')
+
     def show_all_channels(self, title=None):
         """
         show images of all channels in many rows. If image has time points, a slider bar will show up.
@@ -115,206 +215,524 @@ class imageStack():
         print("finished draw_roi")
         return multi_roi
 
+    def measure(self, multi_roi, percentiles=None, average_all_roi=False):
+        """
+        Measure mean, std, min, max, integrated intensity (sum), pixel count (area) and optional
+        percentiles of ROIs, all in one pass over the stack.
+        :param multi_roi: ROI object obtained from `draw_roi2`
+        :param percentiles: optional list of percentiles (0-100), fields 'p<q>', e.g. 'p50'
+        :param average_all_roi: if True, average every statistic over all rois.
+        :return: structured np.array with one field per statistic, e.g. result['mean'];
+                False, (ROI, T, C) for 'TCYX' meta, (ROI, C) for 'CYX' meta
+                True, (T, C) for 'TCYX' meta, (C) for 'CYX' meta.
+                0 if there is no ROI.
+        """
+        if not len(multi_roi.rois):
+            return 0
+        result = measure_rois(self.stack, multi_roi, percentiles)
+        if average_all_roi:
+            average = np.zeros(result.shape[1:], dtype=result.dtype)
+            for name in result.dtype.names:
+                average[name] = np.mean(result[name], axis=0)
+            return average
+        return result
+
+    def segment(self, channel=None, time=None, **kwargs):
+        """
+        Segment cells on one channel or a sum projection of channels, see `segmentation.segment_cells`.
+        :param channel: channel index or list of channel indices, None for all channels
+        :param time: time index for 'TCYX' meta, None for the sum over all time points
+        :param kwargs: threshold, min_size, max_size, opening, closing, fill_holes, smooth
+        :return: 2d int32 label image, 0 is background
+        """
+        return segment_stack(self.stack, channel, time, **kwargs)
+
+    def measure_labels(self, labels, percentiles=None):
+        """
+        Measure the objects of a label image from `segment`, like `measure` does for ROIs.
+        :param labels: 2d int label image, 0 is background
+        :param percentiles: optional list of percentiles (0-100), fields 'p<q>', e.g. 'p50'
+        :return: structured np.array, (label, T, C) for 'TCYX' meta, (label, C) for 'CYX' meta
+        """
+        return measure_labels(self.stack, labels, percentiles)
+
+    def iter_measure(self, rois, percentiles=None, start=0):
+        """
+        Measure a 'TCYX' stack frame by frame, reading one frame at a time (e.g. from an npyStore).
+        Use `measure_frames_to_csv` to append the results to a file as they come.
+        :param rois: ROI object obtained from `draw_roi2`, a roiSet, or a 2d label image from `segment`
+        :param percentiles: optional list of percentiles (0-100), fields 'p<q>', e.g. 'p50'
+        :param start: first frame to measure
+        :return: yields (t, structured np.array (ROI, C))
+        """
+        return iter_measure_frames(self.stack, rois, percentiles, start)
+
     def get_intensity_list(self, multi_roi, average_all_roi=False):
         """
-        Get the mean intensity of ROIs.
+        Get the mean intensity of ROIs. Use `measure` to get several statistics in one pass.
         :param multi_roi: ROI object obtained from `draw_roi2`
         :param average_all_roi: if True, calculate the average for all rois.
         Use True when you have multiple ROIs for background.
         :return: False, np.array (ROI, T, C) for 'TCYX' meta, (ROI, C) for 'CYX' meta
                 True, np,array (T,C) for 'TCYX' meta, (C) for 'CYX' meta.
         """
-        all_list = []
-        if self.meta == 'CYX':
-            if len(multi_roi.rois):
-                for name, roi in multi_roi.rois.items():
-                    temp_roi = np.array([])
-                    for channel in self.stack:
-                        mean, std = roi.get_mean_and_std(channel)
-                        temp_roi = np.append(temp_roi, mean)
-                    all_list.append(temp_roi)
-                ## old implementation: return (C, ROI)
-                # for channel in self.stack:
-                #     channel_list = np.array([])
-                #     for name, roi in multi_roi.rois.items():
-                #         mean, std = roi.get_mean_and_std(channel)
-                #         # print(mean)
-                #         channel_list = np.append(channel_list, mean)
-                #     all_list.append(channel_list)
-                final_list = np.stack(all_list)  # type: ndarray
-                if average_all_roi:
-                    return np.mean(final_list, axis=0)
-                else:
-                    return final_list
-            else:
-                return 0
-        if self.meta == 'TCYX':
-            if len(multi_roi.rois):
-                for name, roi in multi_roi.rois.items():
-                    temp_roi = []
-                    for time in self.stack:
-                        temp_time = np.array([])
-                        for channel in time:
-                            mean, std = roi.get_mean_and_std(channel)
-                            temp_time = np.append(temp_time, mean)
-                        temp_roi.append(temp_time)
-                    all_list.append(np.stack(temp_roi))
-                final_list = np.stack(all_list)  # type: ndarray
-                if average_all_roi:
-                    return np.mean(final_list, axis=0)
-                else:
-                    return final_list
-            else:
-                return 0
-
+        result = self.measure(multi_roi, average_all_roi=average_all_roi)
+        return result['mean'] if len(multi_roi.rois) else 0
 
     def get_noise_list(self, multi_roi, average_all_roi=False):
         """
-        Get the mean intensity of ROIs.
+        Get the standard deviation of intensity in ROIs. Use `measure` to get several statistics in one pass.
         :param multi_roi: ROI object obtained from `draw_roi2`
         :param average_all_roi: if True, calculate the average for all rois.
         Use True when you have multiple ROIs for background.
         :return: False, np.array (ROI, T, C) for 'TCYX' meta, (ROI, C) for 'CYX' meta
                 True, np,array (T,C) for 'TCYX' meta, (C) for 'CYX' meta.
         """
-        all_list = []
-        if self.meta == 'CYX':
-            if len(multi_roi.rois):
-                for name, roi in multi_roi.rois.items():
-                    temp_roi = np.array([])
-                    for channel in self.stack:
-                        mean, std = roi.get_mean_and_std(channel)
-                        temp_roi = np.append(temp_roi, std)
-                    all_list.append(temp_roi)
-                ## old implementation: return (C, ROI)
-                # for channel in self.stack:
-                #     channel_list = np.array([])
-                #     for name, roi in multi_roi.rois.items():
-                #         mean, std = roi.get_mean_and_std(channel)
-                #         # print(mean)
-                #         channel_list = np.append(channel_list, mean)
-                #     all_list.append(channel_list)
-                final_list = np.stack(all_list)  # type: ndarray
-                if average_all_roi:
-                    return np.mean(final_list, axis=0)
-                else:
-                    return final_list
-            else:
-                return 0
-        if self.meta == 'TCYX':
-            if len(multi_roi.rois):
-                for name, roi in multi_roi.rois.items():
-                    temp_roi = []
-                    for time in self.stack:
-                        temp_time = np.array([])
-                        for channel in time:
-                            mean, std = roi.get_mean_and_std(channel)
-                            temp_time = np.append(temp_time, std)
-                        temp_roi.append(temp_time)
-                    all_list.append(np.stack(temp_roi))
-                final_list = np.stack(all_list)  # type: ndarray
-                if average_all_roi:
-                    return np.mean(final_list, axis=0)
-                else:
-                    return final_list
-            else:
-                return 0
+        result = self.measure(multi_roi, average_all_roi=average_all_roi)
+        return result['std'] if len(multi_roi.rois) else 0
+
+    def _planes(self, dtype):
+        """
+        Generator over the YX planes of the stack in C order, converted to dtype one plane at a time
+        """
+        for chunk in self.stack:
+            for plane in np.reshape(chunk, (-1, self.num_y, self.num_x)):
+                yield plane.astype(dtype, copy=False)
 
-    def write_tiff(self, dtype='uint16', file_path=None):
+    def write_tiff(self, dtype='uint16', file_path=None, compression=None, tile=None, bigtiff=None,
+                   channel_names=None, pixel_size=None):
+        """
+        Write the stack to a tiff file plane by plane; peak memory stays at one plane.
+        :param dtype: dtype written to the file
+        :param file_path: ask for a file in GUI if not provided.
+        :param compression: None, 'zlib', or 'zstd' (zstd needs imagecodecs)
+        :param tile: (height, width) of tiles, None to write strips
+        :param bigtiff: None to switch to BigTIFF automatically for files over 4 GB
+        :param channel_names: list of channel names
+        :param pixel_size: pixel size in micrometer
+        :return: file_path
+        """
         if not file_path:
             file_path = tkFileDialog.asksaveasfilename()
-        array2write = self.stack.reshape(-2, self.num_y, self.num_x).astype(dtype)
-        tifffile.imwrite(file_path, array2write, metadata={'axes': self.meta,
-                                                           'images': array2write.shape[0],
-                                                           'frames': self.num_time,
-                                                           'channels': self.num_channel,
-                                                           })
+        write_planes(file_path, self._planes(dtype), self.stack.shape, self.meta, dtype=dtype,
+                     compression=compression, tile=tile, bigtiff=bigtiff,
+                     channel_names=channel_names, pixel_size=pixel_size)
         return file_path
 
-    def write_ome_tiff(self, dtype='uint16', file_path=None):
+    def write_ome_tiff(self, dtype='uint16', file_path=None, compression=None, tile=None, bigtiff=None,
+                       channel_names=None, pixel_size=None):
+        """
+        Write the stack to an OME-TIFF file plane by plane. See `write_tiff` for the parameters.
+        :return: file_path
+        """
         if not file_path:
             file_path = tkFileDialog.asksaveasfilename()
-        with tifffile.TiffWriter(file_path, imagej=True) as tif:
-            array2write = self.stack.astype(dtype)
-            tif.save(array2write, metadata={'axes': self.meta})
+        write_planes(file_path, self._planes(dtype), self.stack.shape, self.meta, dtype=dtype,
+                     compression=compression, tile=tile, bigtiff=bigtiff,
+                     channel_names=channel_names, pixel_size=pixel_size, ome=True)
         return file_path
 
 
+def write_planes(file_path, planes, shape, axes, dtype='uint16', compression=None, tile=None,
+                 bigtiff=None, channel_names=None, pixel_size=None, ome=False):
+    """
+    Write YX planes to a tiff file as they are produced, e.g. from `iter_czi_planes`.
+    Only the plane being written is held in memory.
+    :param file_path: path of the tiff file
+    :param planes: iterable of 2d np.array, in C order of `shape`
+    :param shape: shape of the whole stack, e.g. (T, C, Y, X)
+    :param axes: axes of the whole stack, e.g. 'TCYX'
+    :param dtype: dtype written to the file
+    :param compression: None, 'zlib', or 'zstd' (zstd needs imagecodecs)
+    :param tile: (height, width) of tiles, None to write strips
+    :param bigtiff: None to switch to BigTIFF automatically for files over 4 GB
+    :param channel_names: list of channel names
+    :param pixel_size: pixel size in micrometer
+    :param ome: True to write OME-TIFF metadata
+    :return: file_path
+    """
+    if bigtiff is None:
+        bigtiff = int(np.prod(shape)) * np.dtype(dtype).itemsize > 2 ** 32 - 2 ** 25
+    metadata = {'axes': axes}
+    if channel_names:
+        metadata['Channel'] = {'Name': list(channel_names)}
+    kwargs = {}
+    if pixel_size:
+        metadata['PhysicalSizeX'] = pixel_size
+        metadata['PhysicalSizeY'] = pixel_size
+        kwargs['resolution'] = (1. / pixel_size, 1. / pixel_size)
+        kwargs['resolutionunit'] = 'MICROMETER'
+
+    def data():
+        for plane in planes:
+            plane = np.asarray(plane).astype(dtype, copy=False)
+            if not tile:
+                yield plane
+                continue
+            for y in range(0, plane.shape[0], tile[0]):
+                for x in range(0, plane.shape[1], tile[1]):
+                    yield plane[y:y + tile[0], x:x + tile[1]]
+
+    with tifffile.TiffWriter(file_path, bigtiff=bigtiff, ome=ome) as tif:
+        tif.write(data(), shape=tuple(shape), dtype=dtype, photometric='minisblack',
+                  compression=compression, tile=tile, metadata=metadata, **kwargs)
+    return file_path
+
+
 def read_tiff(file_path=None):
     if not file_path:
         file_path = tkFileDialog.askopenfilename()
-        imageObj = tifffile.imread(file_path)
+    imageObj = tifffile.imread(file_path)
     return (imageObj, file_path)
 
 
-def Read_1by1_TCYX(n_time, n_channel):
-    for t in range(n_time):
-        c_temp_list = []
-        for c in range(n_channel):
-            c_temp_list.append(read_tiff()[0])
-        tArray = np.stack(c_temp_list).astype('float_')
-        if t == 0:
-            # imgArray = tArray[np.newaxis,...].copy()
-            imgArray = tArray[np.newaxis, ...]
-        else:
-            imgArray = np.vstack([imgArray, tArray[np.newaxis, ...]])
-    return imgArray
+def _natural_key(file_path):
+    """
+    Sort key so that 'img_t2' comes before 'img_t10'
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', file_path)]
+
+
+def read_tiff_series(file_list, n_channel, out=None, max_workers=None):
+    """
+    Read single-plane tiff files into one TCYX array. Headers are read first to preallocate the
+    array, then the files are read in parallel straight into their (t, c) slot.
+    :param file_list: list of paths ordered T first, then C (t0c0, t0c1, ..., t1c0, ...),
+                    or a glob pattern, whose matches are sorted in natural order
+    :param n_channel: number of channels per time point
+    :param out: optional (T, C, Y, X) array to fill, e.g. a np.memmap
+    :param max_workers: number of reading threads, None for the ThreadPoolExecutor default
+    :return: np.array (T, C, Y, X) in the acquisition dtype
+    """
+    if isinstance(file_list, str):
+        file_list = sorted(glob.glob(file_list), key=_natural_key)
+    if not file_list or len(file_list) % n_channel:
+        raise Exception("Number of files is not a multiple of n_channel!")
+    n_time = len(file_list) // n_channel
+    with tifffile.TiffFile(file_list[0]) as tif:
+        series = tif.series[0]
+        (num_y, num_x) = series.shape[-2:]
+        dtype = series.dtype
+    if out is None:
+        out = np.empty((n_time, n_channel, num_y, num_x), dtype=dtype)
+
+    def read_one(i):
+        out[i // n_channel, i % n_channel] = tifffile.imread(file_list[i])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(read_one, range(len(file_list))))
+    return out
+
+
+def Read_1by1_TCYX(n_time, n_channel, file_list=None):
+    """
+    Read T x C single-plane tiff files into a TCYX array.
+    :param n_time: number of time points
+    :param n_channel: number of channels
+    :param file_list: list of paths in (T, C) order, or a glob pattern. Glob matches are sorted in
+                      natural order, so img_t0_ch00.tif ... img_t1_ch00.tif come in (T, C) order.
+                      If not provided, all files are selected at once in one GUI dialog.
+    :return: np.array (T, C, Y, X)
+    """
+    if not file_list:
+        file_list = sorted(tkFileDialog.askopenfilenames(), key=_natural_key)
+    if isinstance(file_list, str):
+        file_list = sorted(glob.glob(file_list), key=_natural_key)
+    if len(file_list) != n_time * n_channel:
+        raise Exception("Expected %d files, got %d!" % (n_time * n_channel, len(file_list)))
+    return read_tiff_series(file_list, n_channel)
 
 
 def Read_by_channel(n_channel):
     c_temp_list = []
     for c in range(n_channel):
         c_temp_list.append(read_tiff()[0])
-    tArray = np.stack(c_temp_list, axis=1).astype('float_')
+    tArray = np.stack(c_temp_list, axis=1)
     return tArray
 
 
-def load_msr(file_path=None):
-    """Loads data from the czi file. The data is in a numpy array.
+def _czi_tile(file_path, entry):
+    """
+    Return the YX data of one czi subblock. Uncompressed subblocks are memory-mapped
+    from the file instead of being read into memory.
+    :param file_path: path for the .czi file
+    :param entry: czifile DirectoryEntryDV of the subblock
+    :return: 2d np.array in the acquisition dtype
+    """
+    dtype = np.dtype(entry.dtype)
+    subblock = entry.data_segment()
+    if entry.compression or entry.stored_shape != entry.shape or dtype.shape:
+        tile = subblock.data()
+    else:
+        tile = np.memmap(file_path, dtype=dtype, mode='r', offset=subblock.data_offset,
+                         shape=entry.stored_shape)
+    return tile.reshape(tile.shape[-3:])[..., 0]
+
+
+def _czi_plane_entries(czi):
+    """
+    Group the subblocks of a czi file by the plane they belong to. Pyramid levels are skipped
+    and every dimension other than T, C, Z, Y, X (scene, phase, ...) is kept at its first index.
+    :param czi: an open czifile.CziFile
+    :return: dict {(t, c, z): [(y0, x0, DirectoryEntryDV), ...]}
+    """
+    axes, start = czi.axes, czi.start
+    planes = {}
+    for entry in czi.filtered_subblock_directory:
+        if entry.pyramid_type:
+            continue
+        index = dict((ax, int(i - j)) for ax, i, j in zip(axes, entry.start, start))
+        if any(index[ax] for ax in axes if ax not in 'TCZYX0'):
+            continue
+        key = (index.get('T', 0), index.get('C', 0), index.get('Z', 0))
+        planes.setdefault(key, []).append((index['Y'], index['X'], entry))
+    return planes
+
+
+def czi_dimensions(czi):
+    """
+    Find the real size of the T, C, Z, Y and X axes from the czi subblock directory.
+    :param czi: an open czifile.CziFile
+    :return: dict {'T': n, 'C': n, 'Z': n, 'Y': n, 'X': n}, absent axes have size 1
+    """
+    size = dict(zip(czi.axes, czi.shape))
+    return dict((ax, int(size.get(ax, 1))) for ax in 'TCZYX')
+
+
+def _czi_fill_plane(file_path, tiles, plane):
+    """
+    Paste the tiles of one czi plane into `plane` (Y, X)
+    """
+    for (y0, x0, entry) in tiles:
+        tile = _czi_tile(file_path, entry)
+        plane[y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] = tile
+    return plane
+
+
+def read_czi_channels(file_path, out=None):
+    """
+    Read the first plane of every channel from a czi file, decoding only the subblocks
+    of the first time point, z slice and scene. Mosaic tiles are pasted into place.
+    :param file_path: path for the .czi file
+    :param out: optional (C, Y, X) array to fill, e.g. a np.memmap for scans larger than RAM
+    :return: np.array (C, Y, X) in the acquisition dtype (no float upcast)
+    """
+    with czifile.CziFile(file_path) as czi:
+        dims = czi_dimensions(czi)
+        planes = _czi_plane_entries(czi)
+        if out is None:
+            out = np.zeros((dims['C'], dims['Y'], dims['X']), czi.dtype)
+        for c in range(dims['C']):
+            _czi_fill_plane(file_path, planes.get((0, c, 0), []), out[c])
+    return out
+
+
+def iter_czi_planes(file_path, z=0):
+    """
+    Generator over the planes of a czi file in (T, C) order. Only one plane is decoded at a time,
+    so time-lapse files can be processed without loading the whole file.
+    :param file_path: path for the .czi file
+    :param z: index of the z slice to read
+    :return: yields (t, c, np.array (Y, X)) in the acquisition dtype
+    """
+    with czifile.CziFile(file_path) as czi:
+        dims = czi_dimensions(czi)
+        planes = _czi_plane_entries(czi)
+        for t in range(dims['T']):
+            for c in range(dims['C']):
+                plane = np.zeros((dims['Y'], dims['X']), czi.dtype)
+                yield t, c, _czi_fill_plane(file_path, planes.get((t, c, z), []), plane)
+
+
+def read_czi(file_path=None, out=None):
+    """
+    Read all time points, channels and z slices of a czi file.
     :param file_path: path for the .czi file. Ask for a file in GUI if not provided.
+    :param out: optional array to fill, shaped like the returned stack (e.g. a np.memmap or an
+                npyStore for files larger than RAM)
+    :return: imageStack object, 'TCYX' meta for single z slice, 'TCZYX' meta for z-stacks
+    """
+    if not file_path:
+        file_path = tkFileDialog.askopenfilename()
+    with czifile.CziFile(file_path) as czi:
+        dims = czi_dimensions(czi)
+        planes = _czi_plane_entries(czi)
+        if dims['Z'] == 1:
+            (shape, meta) = ((dims['T'], dims['C'], dims['Y'], dims['X']), 'TCYX')
+        else:
+            (shape, meta) = ((dims['T'], dims['C'], dims['Z'], dims['Y'], dims['X']), 'TCZYX')
+        if out is None:
+            out = np.zeros(shape, czi.dtype)
+        for (t, c, z), tiles in planes.items():
+            index = (t, c) if meta == 'TCYX' else (t, c, z)
+            _czi_fill_plane(file_path, tiles, out[index])
+    return imageStack(imgArray=out, meta=meta)
+
+
+def read_nd2_frames(file_path, iter_axes='c', out=None, max_workers=None, **index):
+    """
+    Decode frames of a nd2 file in parallel, straight into one preallocated array.
+    Every thread opens its own ND2Reader, because a reader shares one file handle.
+    :param file_path: path for the .nd2 file
+    :param iter_axes: nd2 axes to read, in the order of the returned array, e.g. 'c' or 'vtcz'
+    :param out: optional array to fill, shaped like the returned array
+    :param max_workers: number of decoding threads, None for the ThreadPoolExecutor default
+    :param index: fixed index for the axes that are not read, e.g. v=2. Default 0.
+    :return: np.array (*iter_axes, Y, X) in the acquisition dtype
+    """
+    with ND2Reader(file_path) as images:
+        sizes = images.sizes
+        first = images.get_frame_2D(**index)
+    shape = tuple(sizes.get(ax, 1) for ax in iter_axes)
+    if out is None:
+        out = np.empty(shape + first.shape, dtype=first.dtype)
+    local = threading.local()
+    readers = []
+
+    def read_one(position):
+        if not hasattr(local, 'reader'):
+            local.reader = ND2Reader(file_path)
+            readers.append(local.reader)
+        coords = dict(index)
+        coords.update(zip(iter_axes, position))
+        out[position] = local.reader.get_frame_2D(**coords)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(read_one, np.ndindex(*shape)))
+    finally:
+        for reader in readers:
+            reader.close()
+    return out
+
+
+def read_nd2(file_path=None, v=0, out=None, max_workers=None):
+    """
+    Read all time points, channels and z slices of one field of view of a nd2 file,
+    decoding the frames in parallel.
+    :param file_path: path for the .nd2 file. Ask for a file in GUI if not provided.
+    :param v: index of the field of view (multi-point acquisitions)
+    :param out: optional array to fill, shaped like the returned stack
+    :param max_workers: number of decoding threads
+    :return: imageStack object, 'TCYX' meta for single z slice, 'TCZYX' meta for z-stacks
+    """
+    if not file_path:
+        file_path = tkFileDialog.askopenfilename()
+    with ND2Reader(file_path) as images:
+        num_z = images.sizes.get('z', 1)
+    if num_z == 1:
+        imgArray = read_nd2_frames(file_path, 'tc', out=out, max_workers=max_workers, v=v)
+        return imageStack(imgArray=imgArray, meta='TCYX')
+    imgArray = read_nd2_frames(file_path, 'tcz', out=out, max_workers=max_workers, v=v)
+    return imageStack(imgArray=imgArray, meta='TCZYX')
+
+
+def load_msr(file_path=None, cache_dir=CACHE_DIR):
+    """Loads data from the czi file. The data is in a numpy array of the acquisition dtype.
+    :param file_path: path for the .czi file. Ask for a file in GUI if not provided.
+    :param cache_dir: directory of the decoded-data cache (see plane_cache.py), default
+                      $MSR_CACHE_DIR. None reads the file every time.
     :returns: A dict with the name of the stack and the corresponding data
     """
     if not file_path:
         file_path = tkFileDialog.askopenfilename()
     if file_path.endswith("czi"):
-        imageObj = czifile.imread(file_path)
-        numChannel = len(imageObj[0][0])
-        imgList = []
-        for c in range(numChannel):
-            imgList.append(imageObj[0][0][c][0][0].T[0])
-        imgArray = np.stack(imgList).astype('float_')
+        imgArray = cached_load(file_path, read_czi_channels, cache_dir)
     if file_path.endswith("nd2"):
-        imageObj = ND2Reader(file_path)
-        imageObj.iter_axes = 'c'
-        numChannel = len(imageObj)
-        imgList = []
-        for c in range(numChannel):
-            imgList.append(imageObj[c])
-        imgArray = np.stack(imgList).astype('float_')
+        imgArray = cached_load(file_path, read_nd2_frames, cache_dir, iter_axes='c')
     return (imgArray, file_path)
 
 
-def subtract_background(inputstack, bg_mean_list):
+def _empty_like_stack(stack, shape, dtype, suffix):
+    """
+    Allocate an output for a computation on `stack`: an ndarray, or a new npyStore next to the
+    input store (`<input path><suffix>`) so that on-disk stacks stay on disk.
+    """
+    if isinstance(stack, npyStore):
+        return npyStore(stack.path.rstrip(os.sep) + suffix, shape=shape, dtype=dtype)
+    return np.empty(shape, dtype=dtype)
+
+
+def subtract_background(inputstack, bg_mean_list, dtype='float32', out=None):
+    """
+    Subtract background, one float32 chunk at a time. Negative values are clipped to 0.
+    :param inputstack: an imageStack object
+    :param bg_mean_list: averaged intensity array from `get_intensity_list` with `average_all_roi=True`,
+                         or from `estimate_background`: (C,) for 'CYX', (T, C) for 'TCYX',
+                         (T, C) or (T, C, Z) for 'TCZYX'
+    :param dtype: dtype of the returned stack. Use inputstack.stack.dtype to keep the acquisition dtype.
+    :param out: optional array or npyStore to write into. Default is a new array, or a new
+                npyStore '<input path>_bgsub' when the input is stored on disk.
+    :return: imageStack object
+    """
+    bg = np.asarray(bg_mean_list, dtype='float32')
+    allowed = {'CYX': (1,), 'TCYX': (2,), 'TCZYX': (2, 3)}.get(inputstack.meta, ())
+    if bg.ndim not in allowed:
+        raise ValueError("bg_mean_list with %d dimensions does not fit a '%s' stack" % (bg.ndim, inputstack.meta))
+    subtracted = out
+    if subtracted is None:
+        subtracted = _empty_like_stack(inputstack.stack, inputstack.stack.shape, dtype, '_bgsub')
+    for index, chunk in inputstack.float32_chunks():
+        chunk -= bg[index].reshape(bg[index].shape + (1,) * (chunk.ndim - bg.ndim))
+        np.maximum(chunk, 0, out=chunk)
+        if np.issubdtype(subtracted.dtype, np.integer):
+            np.rint(chunk, out=chunk)
+        subtracted[index] = chunk
+    return imageStack(imgArray=subtracted, meta=inputstack.meta)
+
+
+def subtract_background_model(inputstack, method='opening', radius=50, factor=None, dtype='float32', out=None):
     """
-    Subtract background
+    Subtract a per-pixel background (uneven illumination), see `background.background_model`.
+    Computed and subtracted in place in one float32 chunk at a time; negative values are clipped to 0.
     :param inputstack: an imageStack object
-    :param bg_mean_list: averaged intensity array from `get_intensity_list` with `average_all_roi=True`
+    :param method: 'opening', 'rolling_ball' or 'lowpass'
+    :param radius: size of the structures to remove, in pixels; larger than the largest cell
+    :param factor: downsampling factor of the background model, None for automatic
+    :param dtype: dtype of the returned stack. Use inputstack.stack.dtype to keep the acquisition dtype.
+    :param out: optional array or npyStore to write into, e.g. inputstack.stack to overwrite the input.
+                Default is a new array, or a new npyStore '<input path>_bgsub' when the input is stored on disk.
     :return: imageStack object
     """
-    if inputstack.meta == 'CYX' and len(bg_mean_list.shape) == 1:
-        subtracted = inputstack.stack.copy()
-        for c in range(inputstack.num_channel):
-            subtracted[c] = inputstack.stack[c] - bg_mean_list[c]
-        subtracted[subtracted < 0] = 0
-        return imageStack(imgArray=subtracted, meta='CYX')
-    if inputstack.meta == 'TCYX' and len(bg_mean_list.shape) == 2:
-        subtracted = inputstack.stack.copy()
-        for t in range(inputstack.num_time):
-            # c_temp_list = []
-            for c in range(inputstack.num_channel):
-                subtracted[t, c] = inputstack.stack[t, c] - bg_mean_list[t, c]
-        subtracted[subtracted < 0] = 0
-        return imageStack(imgArray=subtracted, meta='TCYX')
+    subtracted = out
+    if subtracted is None:
+        subtracted = _empty_like_stack(inputstack.stack, inputstack.stack.shape, dtype, '_bgsub')
+    for index, chunk in inputstack.float32_chunks():
+        chunk -= background_model(chunk, method, radius, factor)
+        np.maximum(chunk, 0, out=chunk)
+        if np.issubdtype(subtracted.dtype, np.integer):
+            np.rint(chunk, out=chunk)
+        subtracted[index] = chunk
+    return imageStack(imgArray=subtracted, meta=inputstack.meta)
+
+
+def get_ratio(inputstack, numerator, denominator):
+    """
+    Calculate ratio images between channels, one float32 chunk at a time. Pixels with a zero
+    denominator are set to 0.
+    :param inputstack: an imageStack object, 'CYX' or 'TCYX'
+    :param numerator: channel index, or list of channel indices
+    :param denominator: channel index, or list of channel indices, same length as numerator
+    :return: imageStack object of float32 ratios, one channel per (numerator, denominator) pair.
+             Stored in a new npyStore '<input path>_ratio' when the input is stored on disk.
+    """
+    numerator = np.atleast_1d(numerator)
+    denominator = np.atleast_1d(denominator)
+    if inputstack.meta == 'CYX':
+        stack = imageStack(imgArray=np.asarray(inputstack.stack)[np.newaxis], meta='TCYX')
+    else:
+        stack = inputstack
+    ratio = _empty_like_stack(stack.stack, (stack.num_time, len(numerator), stack.num_y, stack.num_x),
+                              'float32', '_ratio')
+    for index, chunk in stack.float32_chunks():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk = np.true_divide(chunk[:, numerator], chunk[:, denominator])
+        np.nan_to_num(chunk, copy=False, posinf=0, neginf=0)
+        np.maximum(chunk, 0, out=chunk)
+        ratio[index] = chunk
+    if inputstack.meta == 'CYX':
+        return imageStack(imgArray=ratio[0], meta='CYX')
+    return imageStack(imgArray=ratio, meta='TCYX')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+"""
+acquisition_index.py  -- index of the acquisitions in a directory, kept in a local SQLite file
+Reads only the headers of czi / nd2 / tiff files (shape, dtype, axes, channel names, pixel size,
+acquisition time) and refreshes changed files by mtime and size.
+required packages: czifile, nd2reader, tifffile
+"""
+import czifile
+from nd2reader import ND2Reader
+import tifffile
+import xml.etree.ElementTree as ET
+import datetime
+import sqlite3
+import json
+import os
+
+INDEX_NAME = '.acquisition_index.sqlite'
+EXTENSIONS = ('.czi', '.nd2', '.tif', '.tiff')
+RESOLUTION_UNIT_UM = {1: 1, 2: 25400, 3: 10000}
+
+
+def read_czi_header(file_path):
+    with czifile.CziFile(file_path) as czi:
+        size = dict(zip(czi.axes, czi.shape))
+        axes = ''.join(ax for ax in 'TCZYX' if ax in size)
+        shape = [int(size[ax]) for ax in axes]
+        dtype = czi.dtype.name
+        meta = ET.fromstring(czi.metadata())
+    channel_names = [ch.get('Name') for ch in meta.iterfind('.//Information/Image/Dimensions/Channels/Channel')]
+    pixel_size = None
+    for distance in meta.iterfind('.//Scaling/Items/Distance'):
+        if distance.get('Id') == 'X' and distance.findtext('Value'):
+            pixel_size = float(distance.findtext('Value')) * 1e6
+    acquired = meta.findtext('.//AcquisitionDateAndTime') or meta.findtext('.//CreationDate')
+    return axes, shape, dtype, channel_names, pixel_size, acquired
+
+
+def read_nd2_header(file_path):
+    with ND2Reader(file_path) as images:
+        sizes = images.sizes
+        axes = ''.join(ax.upper() for ax in 'vtczyx' if ax in sizes)
+        shape = [int(sizes[ax.lower()]) for ax in axes]
+        # the public metadata has no bit depth; only the first frame is decoded
+        dtype = images.get_frame_2D().dtype.name
+        channel_names = list(images.metadata.get('channels') or [])
+        pixel_size = images.metadata.get('pixel_microns')
+        acquired = images.metadata.get('date')
+    return axes, shape, dtype, channel_names, pixel_size, acquired and acquired.isoformat()
+
+
+def read_tiff_header(file_path):
+    with tifffile.TiffFile(file_path) as tif:
+        series = tif.series[0]
+        page = tif.pages[0]
+        axes, shape, dtype = series.axes, [int(i) for i in series.shape], series.dtype.name
+        channel_names = []
+        if tif.shaped_metadata and 'Channel' in tif.shaped_metadata[0]:
+            channel_names = list(tif.shaped_metadata[0]['Channel']['Name'])
+        pixel_size = None
+        if 'XResolution' in page.tags:
+            (num, den) = page.tags['XResolution'].value
+            # micrometers per ResolutionUnit: 2 inch, 3 cm, 1 none (ImageJ writes pixels per micron)
+            unit = int(page.tags['ResolutionUnit'].value) if 'ResolutionUnit' in page.tags else 2
+            if num:
+                pixel_size = float(den) / num * RESOLUTION_UNIT_UM.get(unit, 1)
+        acquired = None
+        if 'DateTime' in page.tags:
+            # tiff DateTime is 'YYYY:MM:DD HH:MM:SS'
+            acquired = page.tags['DateTime'].value.replace(':', '-', 2).replace(' ', 'T')
+    return axes, shape, dtype, channel_names, pixel_size, acquired
+
+
+def read_header(file_path):
+    """
+    Read the acquisition metadata of one file without decoding any image data.
+    :param file_path: path of a .czi, .nd2 or .tif(f) file
+    :return: dict with path, mtime, size, format, axes, shape, dtype, num_channel,
+             channel_names, pixel_size (micrometer) and acquired (ISO date string or None)
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.czi':
+        header = read_czi_header(file_path)
+    elif ext == '.nd2':
+        header = read_nd2_header(file_path)
+    else:
+        header = read_tiff_header(file_path)
+    (axes, shape, dtype, channel_names, pixel_size, acquired) = header
+    stat = os.stat(file_path)
+    num_channel = shape[axes.index('C')] if 'C' in axes else 1
+    return {'path': os.path.abspath(file_path), 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'format': ext.lstrip('.'), 'axes': axes, 'shape': shape, 'dtype': dtype,
+            'num_channel': num_channel, 'channel_names': channel_names,
+            'pixel_size': pixel_size, 'acquired': acquired}
+
+
+def open_index(db_path):
+    """
+    Open (and create if needed) the SQLite index
+    :param db_path: path of the SQLite file
+    :return: sqlite3 connection
+    """
+    con = sqlite3.connect(db_path)
+    con.execute('CREATE TABLE IF NOT EXISTS acquisitions ('
+                'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, format TEXT, axes TEXT, '
+                'shape TEXT, dtype TEXT, num_channel INTEGER, channel_names TEXT, '
+                'pixel_size REAL, acquired TEXT, error TEXT)')
+    return con
+
+
+def update_index(directory, db_path=None, recursive=True):
+    """
+    Scan a directory and refresh the index. Only new files and files whose mtime or size changed
+    are re-read; entries of deleted files are removed. Unreadable files are kept with their error.
+    :param directory: directory with the acquisitions
+    :param db_path: path of the SQLite file, default `directory/.acquisition_index.sqlite`
+    :param recursive: also scan sub-directories
+    :return: (number of files re-read, number of entries removed)
+    """
+    if not db_path:
+        db_path = os.path.join(directory, INDEX_NAME)
+    found = []
+    for root, dirs, files in os.walk(directory):
+        found.extend(os.path.abspath(os.path.join(root, name)) for name in files
+                     if name.lower().endswith(EXTENSIONS))
+        if not recursive:
+            break
+    con = open_index(db_path)
+    known = dict((row[0], (row[1], row[2])) for row in
+                 con.execute('SELECT path, mtime, size FROM acquisitions'))
+    updated = 0
+    for file_path in found:
+        stat = os.stat(file_path)
+        if known.get(file_path) == (stat.st_mtime, stat.st_size):
+            continue
+        try:
+            h = read_header(file_path)
+            row = (file_path, h['mtime'], h['size'], h['format'], h['axes'], json.dumps(h['shape']),
+                   h['dtype'], h['num_channel'], json.dumps(h['channel_names']), h['pixel_size'],
+                   h['acquired'], None)
+        except Exception as e:
+            row = (file_path, stat.st_mtime, stat.st_size, os.path.splitext(file_path)[1].lstrip('.'),
+                   None, None, None, None, None, None, None, repr(e))
+        con.execute('INSERT OR REPLACE INTO acquisitions VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', row)
+        updated += 1
+    removed = [(path,) for path in set(known) - set(found)]
+    con.executemany('DELETE FROM acquisitions WHERE path = ?', removed)
+    con.commit()
+    con.close()
+    return updated, len(removed)
+
+
+def query_index(db_path, num_channel=None, channel=None, since=None, until=None, pattern=None):
+    """
+    Query the index, e.g. all 4-channel files with a 'FRET' channel acquired in the last week:
+    query_index(db, num_channel=4, channel='FRET', since=datetime.datetime.now() - datetime.timedelta(7))
+    :param db_path: path of the SQLite file
+    :param num_channel: number of channels
+    :param channel: text contained in one of the channel names
+    :param since: datetime or ISO string, earliest acquisition time
+    :param until: datetime or ISO string, latest acquisition time
+    :param pattern: SQL LIKE pattern on the path, e.g. '%HeLa%'
+    :return: list of dicts, as returned by `read_header`
+    """
+    where, args = ['error IS NULL'], []
+    if num_channel is not None:
+        where.append('num_channel = ?')
+        args.append(num_channel)
+    if channel:
+        where.append('channel_names LIKE ?')
+        args.append('%' + channel + '%')
+    if since is not None:
+        where.append('acquired >= ?')
+        args.append(since.isoformat() if isinstance(since, datetime.datetime) else since)
+    if until is not None:
+        where.append('acquired <= ?')
+        args.append(until.isoformat() if isinstance(until, datetime.datetime) else until)
+    if pattern:
+        where.append('path LIKE ?')
+        args.append(pattern)
+    con = open_index(db_path)
+    con.row_factory = sqlite3.Row
+    rows = con.execute('SELECT * FROM acquisitions WHERE ' + ' AND '.join(where) + ' ORDER BY acquired, path',
+                       args).fetchall()
+    con.close()
+    result = []
+    for row in rows:
+        entry = dict(row)
+        entry['shape'] = json.loads(entry['shape'])
+        entry['channel_names'] = json.loads(entry['channel_names'])
+        del entry['error']
+        result.append(entry)
+    return result
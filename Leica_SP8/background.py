@@ -0,0 +1,184 @@
+"""
+background.py  -- automatic background estimation, replacing the background ROIs drawn with draw_roi2
+`estimate_background`: one background value per YX plane (channel, time point), vectorized over all
+planes of a chunk. The result has the shape of the stack without YX, i.e. the `bg_mean_list`
+expected by `subtract_background`: (C,) for 'CYX', (T, C) for 'TCYX'.
+`background_model`: a per-pixel background for uneven illumination (morphological opening,
+rolling ball or low-pass), computed on a downsampled copy of the planes and upsampled back.
+required packages: numpy, scipy
+"""
+import numpy as np
+from scipy import ndimage
+
+METHODS = ('percentile', 'mode', 'otsu')
+
+
+def plane_histograms(planes, bins):
+    """
+    Histogram of every plane, each over its own [min, max] range
+    :param planes: (P, N) float np.array
+    :return: counts (P, bins), lower edges (P, 1), bin widths (P, 1)
+    """
+    low = planes.min(axis=1, keepdims=True)
+    width = (planes.max(axis=1, keepdims=True) - low) / bins
+    width[width == 0] = 1
+    index = np.minimum(((planes - low) / width).astype('int64'), bins - 1)
+    index += np.arange(len(planes))[:, np.newaxis] * bins
+    counts = np.bincount(index.ravel(), minlength=len(planes) * bins).reshape(len(planes), bins)
+    return counts, low, width
+
+
+def otsu_thresholds(counts, low, width):
+    """
+    Otsu threshold of every histogram: the bin edge maximizing the between-class variance
+    """
+    centers = low + (np.arange(counts.shape[1]) + 0.5) * width
+    weight0 = np.cumsum(counts, axis=1)
+    weight1 = weight0[:, -1:] - weight0
+    sum0 = np.cumsum(counts * centers, axis=1)
+    sum1 = sum0[:, -1:] - sum0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = weight0 * weight1 * (sum0 / weight0 - sum1 / weight1) ** 2
+    variance = np.nan_to_num(variance[:, :-1], nan=-1)
+    k = np.argmax(variance, axis=1)[:, np.newaxis] if counts.shape[1] > 1 else np.zeros((len(counts), 1), int)
+    return low + (k + 1) * width
+
+
+def plane_background(planes, method='percentile', percentile=5, bins=256):
+    """
+    Background value of every plane
+    :param planes: (P, Y, X) or (P, N) np.array
+    :param method: 'percentile': the `percentile`-th percentile of the plane
+                   'mode': center of the most frequent histogram bin
+                   'otsu': mean of the pixels below the Otsu threshold (cells excluded)
+    :param percentile: percentile (0-100) used by 'percentile'
+    :param bins: number of histogram bins used by 'mode' and 'otsu'
+    :return: (P,) float64 np.array
+    """
+    planes = np.asarray(planes, dtype='float32').reshape(len(planes), -1)
+    if method == 'percentile':
+        return np.percentile(planes, percentile, axis=1)
+    counts, low, width = plane_histograms(planes, bins)
+    if method == 'mode':
+        return (low + (np.argmax(counts, axis=1)[:, np.newaxis] + 0.5) * width)[:, 0].astype('float64')
+    if method == 'otsu':
+        below = planes <= otsu_thresholds(counts, low, width)
+        return np.sum(planes, axis=1, where=below, dtype='float64') / np.sum(below, axis=1)
+    raise ValueError("method has to be one of %s" % (METHODS,))
+
+
+def estimate_background(stack, method='percentile', percentile=5, bins=256):
+    """
+    Estimate the background of every channel and time point, one chunk of the first axis at a time.
+    bg_mean = estimate_background(rawImg, 'otsu') replaces the background ROIs:
+    newImg = subtract_background(rawImg, bg_mean)
+    :param stack: np.array, npyStore or imageStack, 'CYX' or 'TCYX'
+    :param method: 'percentile', 'mode' or 'otsu', see `plane_background`
+    :param percentile: percentile (0-100) used by 'percentile'
+    :param bins: number of histogram bins used by 'mode' and 'otsu'
+    :return: np.array of shape stack.shape[:-2]: (C,) for 'CYX', (T, C) for 'TCYX'
+    """
+    stack = getattr(stack, 'stack', stack)
+    shape = tuple(stack.shape)
+    bg = np.empty(shape[:-2], dtype='float64')
+    for i in range(shape[0]):
+        bg[i] = plane_background(np.asarray(stack[i]).reshape((-1,) + shape[-2:]),
+                                 method, percentile, bins).reshape(shape[1:-2])
+    return bg
+
+
+MODEL_METHODS = ('opening', 'rolling_ball', 'lowpass')
+
+
+def shrink_factor(radius):
+    """
+    Downsampling factor used for a background radius, as in ImageJ's rolling ball
+    """
+    return 1 if radius <= 10 else 2 if radius <= 30 else 4 if radius <= 100 else 8
+
+
+def _downsample(planes, factor, reduce):
+    """
+    Reduce (P, Y, X) planes by factor x factor blocks, padding the edges to a multiple of factor
+    """
+    (num, ny, nx) = planes.shape
+    if ny % factor or nx % factor:
+        planes = np.pad(planes, ((0, 0), (0, -ny % factor), (0, -nx % factor)), mode='edge')
+    blocks = planes.reshape(num, planes.shape[1] // factor, factor, planes.shape[2] // factor, factor)
+    # one axis at a time: reducing the last (contiguous) axis first is much faster
+    return reduce(reduce(blocks, axis=4), axis=2)
+
+
+def _upsample(planes, factor, shape):
+    """
+    Bilinear upsampling of (P, y, x) planes by factor, cropped to (Y, X), one axis at a time
+    """
+    if factor == 1:
+        return planes
+    for axis, size in ((1, shape[0]), (2, shape[1])):
+        # centre of output pixel i in the coordinates of the small planes
+        position = np.clip((np.arange(size) + 0.5) / factor - 0.5, 0, planes.shape[axis] - 1)
+        low = np.floor(position).astype('intp')
+        high = np.minimum(low + 1, planes.shape[axis] - 1)
+        weight = (position - low).astype('float32').reshape((-1, 1) if axis == 1 else (-1,))
+        planes = np.take(planes, low, axis=axis) * (1 - weight) + np.take(planes, high, axis=axis) * weight
+    return planes
+
+
+def _parabola(radius):
+    """
+    Heights of a parabola with the curvature of a ball of `radius` pixels at its top, over [-radius, radius]
+    """
+    r = int(np.ceil(radius))
+    x = np.arange(-r, r + 1)
+    return -x ** 2 / (2.0 * radius)
+
+
+def _paraboloid_opening(planes, radius):
+    """
+    Grey opening of (P, Y, X) planes with the paraboloid -(x^2 + y^2) / (2 * radius), one axis at a time:
+    the paraboloid is the sum of a parabola in x and one in y, so erosion and dilation are separable
+    """
+    height = _parabola(radius)
+    axes = ((1, 1, len(height)), (1, len(height), 1))
+    for filter_1d in (ndimage.grey_erosion, ndimage.grey_dilation):
+        for shape in axes:
+            planes = filter_1d(planes, footprint=np.ones(shape, dtype=bool), structure=height.reshape(shape),
+                               mode='nearest')
+    return planes
+
+
+def background_model(planes, method='opening', radius=50, factor=None):
+    """
+    Per-pixel background of every plane, for uneven illumination.
+    The filters run on planes downsampled by `factor` (block minimum, block mean for 'lowpass')
+    and are upsampled back bilinearly, so the cost hardly depends on the radius.
+    Cost per 2048 x 2048 plane with radius 50: 0.1 - 0.2 s, i.e. under 2 minutes per channel of a
+    500-frame time-lapse. 'opening' is the fastest and the recommended default.
+    :param planes: (Y, X) or (P, Y, X) np.array
+    :param method: 'opening': grey opening with a square of 2 * radius + 1 (separable min / max filters)
+                   'rolling_ball': grey opening with a paraboloid of the curvature of a ball of `radius`
+                   (intensity in pixel units, as ImageJ's sliding paraboloid), separable like 'opening'
+                   'lowpass': gaussian filter with sigma = radius (separable)
+    :param radius: size of the structures to remove, in pixels; larger than the largest cell
+    :param factor: downsampling factor, None for `shrink_factor(radius)`
+    :return: float32 np.array, same shape as planes
+    """
+    planes = np.asarray(planes, dtype='float32')
+    shape = planes.shape
+    planes = planes.reshape((-1,) + shape[-2:])
+    if factor is None:
+        factor = shrink_factor(radius)
+    small_radius = radius / float(factor)
+    if method == 'lowpass':
+        small = _downsample(planes, factor, np.mean)
+        small = ndimage.gaussian_filter(small, (0, small_radius, small_radius), mode='nearest')
+    elif method == 'opening':
+        small = _downsample(planes, factor, np.min)
+        size = (1, 2 * int(round(small_radius)) + 1, 2 * int(round(small_radius)) + 1)
+        small = ndimage.maximum_filter(ndimage.minimum_filter(small, size, mode='nearest'), size, mode='nearest')
+    elif method == 'rolling_ball':
+        small = _paraboloid_opening(_downsample(planes, factor, np.min), small_radius)
+    else:
+        raise ValueError("method has to be one of %s" % (MODEL_METHODS,))
+    return _upsample(small.astype('float32'), factor, shape[-2:]).reshape(shape)
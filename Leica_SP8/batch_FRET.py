@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+"""
+batch_FRET.py  -- headless batch version of FRET_image.py / Confocal.py
+Runs background subtraction, bleed-through correction, ratio / Eapp and measurements
+for every czi / nd2 file in a directory (or matching a glob), one worker process per file.
+Usage: python batch_FRET.py [directory or glob] [output directory]
+required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
+"""
+
+from bleedthrough import *
+from roi_measure import load_rois, measure_labels
+from background import estimate_background, MODEL_METHODS
+from segmentation import segment_stack
+import kernels
+from measurement_table import measurementTable
+import tifffile
+import os
+import sys
+import glob
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+######################## User defined parameters ###################
+InputPath = os.getcwd()     # directory, or glob such as "data/*HeLa*.czi"
+OutputPath = None           # None: results next to the input files
+Workers = None              # None: one worker per CPU core
+CopyRaw = False             # copy the raw file into its output folder, as FRET_image.py does
+Backend = 'auto'            # per-pixel arithmetic: 'numba', 'numexpr', 'numpy', or 'auto' for the first installed
+
+matrix = [
+    [0,                   0.593801816323638, 0.00215154144896414, 0],
+    [0,                   0,                 0,                   0],
+    [0.00444907313846516, 0.134907791322414, 0,                   0],
+    [0,                   0,                 0,                   0]
+]
+# True: exact linear unmixing with the inverse of the mixing matrix, False: first-order subtraction
+Unmix = False
+# Background values per channel, measured once for the whole plate
+BgMean = [0, 0, 0, 0]
+# ROI sets saved by FRET_image.py, looked up in the output folder of each file (or an absolute path).
+# When found, the background ROIs replace BgMean and the cell ROIs replace the whole-field measurements.
+BgRoiFile = "bg_rois.npz"
+CellRoiFile = "cell_rois.npz"
+# Without cell ROIs: True to segment cells automatically and measure every cell
+SegmentCells = False
+SegChannel = None       # channel index (or list) to segment on, None for the sum of all channels
+MinCellSize = 50        # pixels
+MaxCellSize = None      # pixels, None for no limit
+# Without background ROIs: None to use BgMean, 'percentile', 'mode' or 'otsu' to estimate it per file,
+# or 'opening', 'rolling_ball' or 'lowpass' to subtract a per-pixel background (uneven illumination)
+BgMethod = None
+BgRadius = 50           # pixels, for the per-pixel background; larger than the largest cell
+
+# FRET information
+CalcRatio = True
+CalcEapp = True
+CFPIndex = 0  # first channel
+FRETIndex = 1  # second channel
+
+G = 2.845178   # if 0 then no Eapp calculation
+
+MeasureRaw = True
+# measurement tables: None for parquet (if pyarrow is installed) or npz, or 'feather', 'npz', 'csv'
+OutputFormat = None
+
+######################### Don't change after this line
+
+
+def find_files(input_path):
+    """
+    List the files to process
+    :param input_path: a directory (all .czi and .nd2 files in it) or a glob pattern
+    :return: sorted list of file paths
+    """
+    if os.path.isdir(input_path):
+        file_list = glob.glob(os.path.join(input_path, "*.czi")) + glob.glob(os.path.join(input_path, "*.nd2"))
+    else:
+        file_list = glob.glob(input_path)
+    return sorted(file_list)
+
+
+def process_fret_file(file_path, out_root, params):
+    """
+    Process one file the way FRET_image.py does, without any GUI.
+    Writes corrected.tiff, ratio.tiff, Eapp.tiff and the measurements and raw tables
+    (see measurement_table.py, format params['OutputFormat']) into
+    out_root/<file name>/. Background and measurements use the ROI sets saved there by FRET_image.py
+    (params['BgRoiFile'], params['CellRoiFile']) when present, otherwise the background estimated with
+    params['BgMethod'] (or BgMean), and the cells segmented with params['SegmentCells'] (labels.tiff)
+    or whole-field means (roi 0). Ratio and Eapp are the channels after the corrected channels.
+    :param file_path: path of the .czi / .nd2 file
+    :param out_root: folder where the per-file output folder is created
+    :param params: dict with the user defined parameters of this script
+    :return: path of the output folder
+    """
+    kernels.set_backend(params.get('Backend') or 'auto')
+    (rawImg, path) = load_msr(file_path)
+    prefix = os.path.basename(path).split(".")[0]
+    out_dir = os.path.join(out_root, prefix)
+    os.makedirs(out_dir, exist_ok=True)
+    if params['CopyRaw']:
+        shutil.copy(path, out_dir)
+
+    bg_roi_path = os.path.join(out_dir, params.get('BgRoiFile') or '')
+    cell_roi_path = os.path.join(out_dir, params.get('CellRoiFile') or '')
+    (source, offset) = (rawImg, None)
+    if os.path.isfile(bg_roi_path):
+        bg_mean = np.mean(get_intensity_list(load_rois(bg_roi_path), rawImg).reshape(len(rawImg), -1), axis=1)
+    elif params.get('BgMethod') in MODEL_METHODS:
+        source = subtract_background_model(rawImg, params['BgMethod'], params['BgRadius'])
+        bg_mean = np.mean(np.subtract(rawImg, source, dtype='float32'), axis=(1, 2))
+        offset = np.zeros(len(rawImg))
+    elif params.get('BgMethod'):
+        bg_mean = estimate_background(rawImg, method=params['BgMethod'])
+    else:
+        bg_mean = np.asarray(params['BgMean'], dtype='float32')[:len(rawImg)]
+
+    # background, bleed-through, ratio and Eapp in one pass
+    corrImg = np.empty(rawImg.shape, dtype='uint16')
+    ratio_list = []
+    if params['CalcRatio']:
+        ratio_list.append(np.empty(rawImg.shape[1:], dtype='float32'))
+        if params['CalcEapp'] and params['G']:
+            ratio_list.append(np.empty(rawImg.shape[1:], dtype='float32'))
+    correct_fret(source, bg_mean if offset is None else offset,
+                 np.asarray(params['matrix'])[:len(rawImg), :len(rawImg)], params['CFPIndex'], params['FRETIndex'],
+                 params['G'], corrImg, *ratio_list, unmix=params.get('Unmix', False))
+    for (name, img) in zip(("ratio.tiff", "Eapp.tiff"), ratio_list):
+        tifffile.imwrite(os.path.join(out_dir, name), img, metadata={'axes': 'YX'})
+    tifffile.imwrite(os.path.join(out_dir, "corrected.tiff"), corrImg, metadata={'axes': 'CYX'})
+
+    if os.path.isfile(cell_roi_path):
+        cell_rois = load_rois(cell_roi_path)
+        allImg = np.vstack((corrImg, np.reshape(ratio_list, (-1,) + corrImg.shape[1:])))
+        OutTable = get_intensity_list(cell_rois, allImg).transpose((1, 0))
+        RawTable = get_intensity_list(cell_rois, rawImg).transpose((1, 0)) if params['MeasureRaw'] else None
+        roi = None
+    elif params.get('SegmentCells'):
+        labels = segment_stack(corrImg, params['SegChannel'], min_size=params['MinCellSize'],
+                               max_size=params['MaxCellSize'])
+        tifffile.imwrite(os.path.join(out_dir, "labels.tiff"), labels, metadata={'axes': 'YX'})
+        allImg = np.vstack((corrImg, np.reshape(ratio_list, (-1,) + corrImg.shape[1:])))
+        OutTable = measure_labels(allImg, labels)
+        RawTable = measure_labels(rawImg, labels) if params['MeasureRaw'] else None
+        roi = None
+    else:
+        OutTable = np.concatenate((corrImg.mean(axis=(1, 2)), [img.mean() for img in ratio_list]))[np.newaxis]
+        RawTable = rawImg.mean(axis=(1, 2))[np.newaxis]
+        roi = 0
+    name = os.path.basename(path)
+    measurementTable().add(OutTable, file=name, roi=roi).write(os.path.join(out_dir, "measurements"),
+                                                                params.get('OutputFormat'))
+    if params['MeasureRaw']:
+        raw_table = measurementTable().add(np.reshape(bg_mean, (1, -1)), 'background', file=name, roi=0)
+        raw_table.add(RawTable, file=name, roi=roi).write(os.path.join(out_dir, "raw"), params.get('OutputFormat'))
+    return out_dir
+
+
+def _process_safe(file_path, out_root, params):
+    try:
+        return file_path, process_fret_file(file_path, out_root, params), None
+    except Exception:
+        return file_path, None, traceback.format_exc()
+
+
+def run_batch(input_path, out_root=None, params=None, workers=None):
+    """
+    Process all files found by `find_files` in a process pool, one worker per file.
+    A failing file is reported and does not stop the batch.
+    :param input_path: a directory or a glob pattern
+    :param out_root: output folder, None to write next to each input file
+    :param params: dict of user defined parameters
+    :param workers: number of worker processes, None for one per CPU core
+    :return: list of (file_path, output folder or None, error message or None)
+    """
+    file_list = find_files(input_path)
+    print("found", len(file_list), "files in", input_path)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_process_safe, file_path, out_root or os.path.dirname(file_path), params)
+                   for file_path in file_list]
+        for future in as_completed(futures):
+            file_path, out_dir, error = future.result()
+            if error:
+                print("failed:", file_path, "\n", error)
+            else:
+                print("done:", file_path, "->", out_dir)
+            results.append((file_path, out_dir, error))
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        InputPath = sys.argv[1]
+    if len(sys.argv) > 2:
+        OutputPath = sys.argv[2]
+    params = {'matrix': matrix, 'Unmix': Unmix, 'BgMean': BgMean, 'CopyRaw': CopyRaw,
+              'CalcRatio': CalcRatio, 'CalcEapp': CalcEapp,
+              'CFPIndex': CFPIndex, 'FRETIndex': FRETIndex, 'G': G,
+              'MeasureRaw': MeasureRaw, 'BgRoiFile': BgRoiFile, 'CellRoiFile': CellRoiFile,
+              'BgMethod': BgMethod, 'BgRadius': BgRadius, 'SegmentCells': SegmentCells, 'SegChannel': SegChannel,
+              'MinCellSize': MinCellSize, 'MaxCellSize': MaxCellSize,
+              'OutputFormat': OutputFormat, 'Backend': Backend}
+    run_batch(InputPath, OutputPath, params, Workers)
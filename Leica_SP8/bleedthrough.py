@@ -10,6 +10,7 @@ import czifile
 from nd2reader import ND2Reader
 import matplotlib.pyplot as plt
 import numpy as np
+from functools import lru_cache
 # import Tkinter as tk      #using python2
 import tkinter as tk  # using python2
 # import tkFileDialog       #using python2
@@ -20,37 +21,117 @@ from math import ceil, sqrt
 import tifffile
 from matplotlib.widgets import Slider
 from scipy.stats import linregress
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from plane_cache import cached_load, CACHE_DIR
+from roi_measure import roi_mean_std
+from background import background_model
+import kernels
 
 
-def load_msr(file_path=None):
-    """Loads data from the czi file. The data is in a numpy array.
+def _czi_tile(file_path, entry):
+    """
+    Return the YX data of one czi subblock. Uncompressed subblocks are memory-mapped
+    from the file instead of being read into memory.
+    :param file_path: path for the .czi file
+    :param entry: czifile DirectoryEntryDV of the subblock
+    :return: 2d np.array in the acquisition dtype
+    """
+    dtype = np.dtype(entry.dtype)
+    subblock = entry.data_segment()
+    if entry.compression or entry.stored_shape != entry.shape or dtype.shape:
+        tile = subblock.data()
+    else:
+        tile = np.memmap(file_path, dtype=dtype, mode='r', offset=subblock.data_offset,
+                         shape=entry.stored_shape)
+    return tile.reshape(tile.shape[-3:])[..., 0]
+
+
+def read_czi_channels(file_path, out=None):
+    """
+    Read the first plane of every channel from a czi file, decoding only the subblocks
+    of the first time point, z slice and scene. Mosaic tiles are pasted into place.
+    :param file_path: path for the .czi file
+    :param out: optional (C, Y, X) array to fill, e.g. a np.memmap for scans larger than RAM
+    :return: np.array (C, Y, X) in the acquisition dtype (no float upcast)
+    """
+    with czifile.CziFile(file_path) as czi:
+        axes, start, shape = czi.axes, czi.start, czi.shape
+        y_ax, x_ax = axes.index('Y'), axes.index('X')
+        c_ax = axes.index('C') if 'C' in axes else None
+        num_channel = shape[c_ax] if c_ax is not None else 1
+        if out is None:
+            out = np.zeros((num_channel, shape[y_ax], shape[x_ax]), czi.dtype)
+        for entry in czi.filtered_subblock_directory:
+            if entry.pyramid_type:
+                continue
+            if any(entry.start[i] != start[i] for i, ax in enumerate(axes) if ax not in 'CYX0'):
+                continue
+            tile = _czi_tile(file_path, entry)
+            c = entry.start[c_ax] - start[c_ax] if c_ax is not None else 0
+            y0 = entry.start[y_ax] - start[y_ax]
+            x0 = entry.start[x_ax] - start[x_ax]
+            out[c, y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] = tile
+    return out
+
+
+def read_nd2_frames(file_path, iter_axes='c', out=None, max_workers=None, **index):
+    """
+    Decode frames of a nd2 file in parallel, straight into one preallocated array.
+    Every thread opens its own ND2Reader, because a reader shares one file handle.
+    :param file_path: path for the .nd2 file
+    :param iter_axes: nd2 axes to read, in the order of the returned array, e.g. 'c' or 'vtcz'
+    :param out: optional array to fill, shaped like the returned array
+    :param max_workers: number of decoding threads, None for the ThreadPoolExecutor default
+    :param index: fixed index for the axes that are not read, e.g. v=2. Default 0.
+    :return: np.array (*iter_axes, Y, X) in the acquisition dtype
+    """
+    with ND2Reader(file_path) as images:
+        sizes = images.sizes
+        first = images.get_frame_2D(**index)
+    shape = tuple(sizes.get(ax, 1) for ax in iter_axes)
+    if out is None:
+        out = np.empty(shape + first.shape, dtype=first.dtype)
+    local = threading.local()
+    readers = []
+
+    def read_one(position):
+        if not hasattr(local, 'reader'):
+            local.reader = ND2Reader(file_path)
+            readers.append(local.reader)
+        coords = dict(index)
+        coords.update(zip(iter_axes, position))
+        out[position] = local.reader.get_frame_2D(**coords)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(read_one, np.ndindex(*shape)))
+    finally:
+        for reader in readers:
+            reader.close()
+    return out
+
+
+def load_msr(file_path=None, cache_dir=CACHE_DIR):
+    """Loads data from the czi file. The data is in a numpy array of the acquisition dtype.
     :param file_path: path for the .czi file. Ask for a file in GUI if not provided.
+    :param cache_dir: directory of the decoded-data cache (see plane_cache.py), default
+                      $MSR_CACHE_DIR. None reads the file every time.
     :returns: A dict with the name of the stack and the corresponding data
     """
     if not file_path:
         file_path = tkFileDialog.askopenfilename()
     if file_path.endswith("czi"):
-        imageObj = czifile.imread(file_path)
-        numChannel = len(imageObj[0][0])
-        imgList = []
-        for c in range(numChannel):
-            imgList.append(imageObj[0][0][c][0][0].T[0])
-        imgArray = np.stack(imgList).astype('float_')
+        imgArray = cached_load(file_path, read_czi_channels, cache_dir)
     if file_path.endswith("nd2"):
-        imageObj = ND2Reader(file_path)
-        imageObj.iter_axes = 'c'
-        numChannel = len(imageObj)
-        imgList = []
-        for c in range(numChannel):
-            imgList.append(imageObj[c])
-        imgArray = np.stack(imgList).astype('float_')
+        imgArray = cached_load(file_path, read_nd2_frames, cache_dir, iter_axes='c')
     return (imgArray, file_path)
 
 
 def read_tiff(file_path=None):
     if not file_path:
         file_path = tkFileDialog.askopenfilename()
-        imageObj = tifffile.imread(file_path)
+    imageObj = tifffile.imread(file_path)
     return (imageObj, file_path)
 
 
@@ -182,25 +263,38 @@ def draw_roi2(multi_channel, title="Click on the button to add a new ROI"):
 
 
 def get_intensity_list(multi_roi, multi_channel):
-    all_list = []
+    """
+    Get the mean intensity of ROIs; all ROIs are rasterized once, see roi_measure.py
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :param multi_channel: 3d np.array image stack
+    :return: np.array (C, ROI), zeros (C) without ROIs
+    """
     if len(multi_roi.rois):
-        for channel in multi_channel:
-            channel_list = np.array([])
-            for name, roi in multi_roi.rois.items():
-                mean, std = roi.get_mean_and_std(channel)
-                # print(mean)
-                channel_list = np.append(channel_list, mean)
-            all_list.append(channel_list)
-        final_list = np.stack(all_list)  # type: ndarray
+        (mean, std) = roi_mean_std(multi_channel, multi_roi)
+        final_list = mean.T  # type: ndarray
         return final_list
     else:
         return np.zeros(len(multi_channel))
 
 
 def subtract_background(multi_channel, bg_mean_list):
-    subtracted = multi_channel.copy()
-    for i in range(len(multi_channel)):
-        subtracted[i] = multi_channel[i] - bg_mean_list[i]
+    # float32 result so that unsigned raw data from load_msr cannot wrap around below 0
+    subtracted = np.subtract(multi_channel, np.reshape(bg_mean_list, (-1, 1, 1)), dtype='float32')
+    return subtracted
+
+
+def subtract_background_model(multi_channel, method='opening', radius=50):
+    """
+    Subtract a per-pixel background (uneven illumination) from every channel, see `background_model`
+    :param multi_channel: np.array, 3-d stack
+    :param method: 'opening', 'rolling_ball' or 'lowpass'
+    :param radius: size of the structures to remove, in pixels; larger than the largest cell
+    :return: float32 np.array, negative values clipped to 0
+    """
+    subtracted = np.array(multi_channel, dtype='float32')
+    for channel in subtracted:
+        channel -= background_model(channel, method, radius)
+    np.maximum(subtracted, 0, out=subtracted)
     return subtracted
 
 
@@ -254,64 +348,244 @@ def show_all_channels_with_roi2(multi_channel, multi_roi):
     return 0
 
 
-def get_slope(roi_list):
+def _slope_rsq(sxy, sy, num):
     """
-    calculate the bleed-through coefficient by linear regression, y-intercept fixed at 0
-    :param roi_list: intensity list generated by get_intensity_list
-    :return: array of slopes, array of standard deviation
+    Through-origin slopes and R^2 of all channel pairs from sufficient statistics
+    :param sxy: (..., C, C) sums of x_i * x_j over ROIs
+    :param sy: (..., C) sums of x_j over ROIs
+    :param num: number of ROIs
+    :return: slope (..., C, C), rsq (..., C, C); [i, j] regresses channel j on channel i
+    """
+    sxx = np.diagonal(sxy, axis1=-2, axis2=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx[..., :, np.newaxis]
+        # residual sum of squares of y = slope * x: Syy - Sxy^2 / Sxx
+        sse = sxx[..., np.newaxis, :] - sxy * slope
+        sst = sxx - sy ** 2 / num
+        rsq = 1 - sse / sst[..., np.newaxis, :]
+    return slope, rsq
+
+
+def get_slope(roi_list, verbose=True):
+    """
+    calculate the bleed-through coefficient by linear regression, y-intercept fixed at 0,
+    for all channel pairs at once from the sums of products over ROIs
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param verbose: print the coefficients of every channel pair
+    :return: array of slopes, array of r-squared; [i][j] is from channel i to channel j
     """
-    num_channel = len(roi_list)
-    slope_array = np.zeros([num_channel, num_channel])
-    rsq_array = np.zeros([num_channel, num_channel])
-    for i in range(num_channel):
-        for j in range(num_channel):
-            # reg = linregress(roi_list[i], roi_list[j])
-            # slope = reg.slope
-            # rsq = reg.rvalue
-            x = roi_list[i][:, np.newaxis]
-            y = roi_list[j]
-            slope, SSE, _, _, = np.linalg.lstsq(x, y, rcond=None)
-            rsq = 1 - (SSE / ((y ** 2).sum() - (len(y) * (y.mean()) ** 2)))
-            slope_array[i][j] = float(slope)
-            rsq_array[i][j] = float(rsq)
-            if i != j:
-                print("Channel", i + 1, "to Channel", j + 1, slope, rsq)
+    x = np.asarray(roi_list, dtype='float64')
+    (slope_array, rsq_array) = _slope_rsq(x @ x.T, x.sum(axis=1), x.shape[1])
+    if verbose:
+        for (i, j) in zip(*np.nonzero(~np.eye(len(x), dtype=bool))):
+            print("Channel", i + 1, "to Channel", j + 1, slope_array[i, j], rsq_array[i, j])
     return slope_array, rsq_array
 
 
-def get_coefficient(roi_list):
+def get_coefficient(roi_list, verbose=True):
     """
     calculate the bleed-through coefficient by averaging the ratio
-    :param roi_list: intensity list generated by get_intensity_list
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param verbose: print the coefficients of every channel pair
     :return: array of slopes, array of standard deviation
     """
-    num_channel = len(roi_list)
-    slope_array = np.zeros([num_channel, num_channel])
-    std_array = np.zeros([num_channel, num_channel])
-    for i in range(num_channel):
-        for j in range(num_channel):
-            # reg = linregress(roi_list[i], roi_list[j])
-            slp = roi_list[j] / roi_list[i]
-            slope = slp.mean()
-            sd = slp.std()
-            slope_array[i][j] = slope
-            std_array[i][j] = sd
-            if i != j:
-                print("Channel", i + 1, "to Channel", j + 1, slope, sd)
+    x = np.asarray(roi_list, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = x[np.newaxis, :, :] / x[:, np.newaxis, :]
+    (slope_array, std_array) = (ratio.mean(axis=2), ratio.std(axis=2))
+    if verbose:
+        for (i, j) in zip(*np.nonzero(~np.eye(len(x), dtype=bool))):
+            print("Channel", i + 1, "to Channel", j + 1, slope_array[i, j], std_array[i, j])
     return slope_array, std_array
 
 
-def subtract_bt(multi_channel, bt_array):
-    num_channel = len(multi_channel)
-    new_list = []
-    for j in range(num_channel):
-        temp = multi_channel[j].copy()
-        for i in range(num_channel):
-            if i != j:
-                temp = temp - bt_array[i][j] * multi_channel[i]
-        new_list.append(temp)
-    new_stack = np.stack(new_list)
-    return new_stack
+def bootstrap_coefficients(roi_list, method='slope', num_boot=1000, ci=95, seed=None, chunk_size=100):
+    """
+    Bootstrap over ROIs: confidence intervals of the bleed-through coefficients of all channel pairs.
+    Every resample is a weighting of the ROIs (how often each ROI is drawn), so all pairs of all
+    resamples come from one matrix product with the per-ROI products.
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param method: 'slope' as `get_slope`, or 'ratio' as `get_coefficient`
+    :param num_boot: number of resamples
+    :param ci: confidence level in percent
+    :param seed: seed of the random generator
+    :param chunk_size: number of resamples computed together
+    :return: coefficients (C, C), lower bounds (C, C), upper bounds (C, C)
+    """
+    x = np.asarray(roi_list, dtype='float64')
+    (num_channel, num) = x.shape
+    if method == 'slope':
+        # per-ROI products x_i * x_j and values x_j
+        terms = np.concatenate(((x[:, np.newaxis, :] * x[np.newaxis, :, :]).reshape(-1, num), x))
+        estimate = get_slope(x, verbose=False)[0]
+    elif method == 'ratio':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = (x[np.newaxis, :, :] / x[:, np.newaxis, :]).reshape(-1, num)
+        estimate = get_coefficient(x, verbose=False)[0]
+    else:
+        raise ValueError("method has to be 'slope' or 'ratio'")
+    rng = np.random.default_rng(seed)
+    samples = []
+    for start in range(0, num_boot, chunk_size):
+        size = min(chunk_size, num_boot - start)
+        draws = rng.integers(0, num, (size, num)) + np.arange(size)[:, np.newaxis] * num
+        weights = np.bincount(draws.ravel(), minlength=size * num).reshape(size, num).astype('float64')
+        sums = weights @ terms.T
+        if method == 'slope':
+            sxy = sums[:, :num_channel ** 2].reshape(size, num_channel, num_channel)
+            samples.append(_slope_rsq(sxy, sums[:, num_channel ** 2:], num)[0])
+        else:
+            samples.append(sums.reshape(size, num_channel, num_channel) / num)
+    samples = np.concatenate(samples)
+    (low, high) = np.nanpercentile(samples, [(100 - ci) / 2., (100 + ci) / 2.], axis=0)
+    return estimate, low, high
+
+
+def bt_correction_matrix(bt_array, num_channel=None):
+    """
+    Matrix M so that the corrected channels are M @ channels: 1 on the diagonal and -bt_array[i][j]
+    at [j, i], i.e. channel j - sum over i != j of bt_array[i][j] * channel i.
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param num_channel: number of channels of the image. Only the top-left block of bt_array is used,
+                        so a matrix for more channels (e.g. the 4x4 defaults) works on fewer.
+    :return: (C, C) float32 np.array
+    """
+    matrix = -np.array(bt_array, dtype='float32')[:num_channel, :num_channel].T
+    np.fill_diagonal(matrix, 1)
+    return matrix
+
+
+def _apply_channel_matrix(multi_channel, matrix, out=None, clip=False, block_size=65536):
+    """
+    out = matrix @ channels for every pixel, one frame and one block of pixels at a time
+    """
+    if out is None:
+        out = np.empty(multi_channel.shape, dtype='float32')
+    if len(multi_channel.shape) == 3:
+        (frames, out_frames) = (np.asarray(multi_channel)[np.newaxis], out[np.newaxis])
+    else:
+        (frames, out_frames) = (multi_channel, out)
+    num_channel = frames.shape[1]
+    size = frames.shape[2] * frames.shape[3]
+    for t in range(len(frames)):
+        frame = np.asarray(frames[t]).reshape(num_channel, size)
+        target = out_frames[t]
+        if not target.flags.c_contiguous:
+            raise ValueError("out has to be C-contiguous")
+        target = target.reshape(num_channel, size)
+        kernels.contract_frame(frame, matrix, target, block_size)
+        if clip:
+            np.maximum(target, 0, out=target)
+    return out
+
+
+def subtract_bt(multi_channel, bt_array, out=None, block_size=65536):
+    """
+    Subtract bleed-through as one contraction over the channel axis, one frame and one block of
+    pixels at a time, so that only a small float32 buffer is allocated. Runs on the backend chosen
+    with kernels.set_backend (numba, numexpr or numpy).
+    :param multi_channel: np.array, CYX or TCYX
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param out: optional C-contiguous array of the same shape to write into, e.g. multi_channel itself
+                (float) for in-place correction
+    :param block_size: number of pixels per block
+    :return: float32 np.array (or out)
+    """
+    matrix = bt_correction_matrix(bt_array, multi_channel.shape[-3])
+    return _apply_channel_matrix(multi_channel, matrix, out, False, block_size)
+
+
+def unmixing_matrix(bt_array, num_channel=None):
+    """
+    Exact unmixing: the inverse of the full mixing matrix, where measured channel j is
+    true channel j + sum over i != j of bt_array[i][j] * true channel i. Computed once per matrix;
+    a singular mixing matrix gets its pseudo-inverse.
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param num_channel: number of channels of the image, only the top-left block of bt_array is used
+    :return: (C, C) float32 np.array, true channels = matrix @ measured channels
+    """
+    key = np.ascontiguousarray(np.array(bt_array, dtype='float64')[:num_channel, :num_channel])
+    return _unmixing_matrix(key.tobytes(), key.shape).copy()
+
+
+@lru_cache(maxsize=32)
+def _unmixing_matrix(data, shape):
+    mixing = np.frombuffer(data).reshape(shape).T.copy()
+    np.fill_diagonal(mixing, 1)
+    if np.linalg.matrix_rank(mixing) < len(mixing):
+        return np.linalg.pinv(mixing).astype('float32')
+    return np.linalg.inv(mixing).astype('float32')
+
+
+def unmix(multi_channel, bt_array, out=None, clip=False, block_size=65536):
+    """
+    Remove bleed-through exactly, by applying the inverse mixing matrix (see `unmixing_matrix`) to
+    every pixel. `subtract_bt` is the first-order approximation, which subtracts bleed-through
+    estimated from the uncorrected channels. Same cost as `subtract_bt`.
+    :param multi_channel: np.array, CYX or TCYX
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param out: optional C-contiguous array of the same shape to write into, e.g. multi_channel itself
+                (float) for in-place unmixing
+    :param clip: clip negative values at 0
+    :param block_size: number of pixels per block
+    :return: float32 np.array (or out)
+    """
+    matrix = unmixing_matrix(bt_array, multi_channel.shape[-3])
+    return _apply_channel_matrix(multi_channel, matrix, out, clip, block_size)
+
+
+def correct_fret(multi_channel, bg_mean_list, bt_array, cfp_index=0, fret_index=1, g=0,
+                 corrected=None, ratio=None, eapp=None, block_size=65536, unmix=False):
+    """
+    Background subtraction, clip, bleed-through correction, ratio and Eapp in one pass over blocks
+    of pixels, written into preallocated outputs; no full-size intermediate is created.
+    Same results as subtract_background -> clip -> subtract_bt -> ratio -> Eapp -> clip, except
+    that pixels with a zero CFP value get a ratio of 0. Runs on the backend chosen with
+    kernels.set_backend (numba, numexpr or numpy).
+    :param multi_channel: np.array, CYX or TCYX, any dtype
+    :param bg_mean_list: background per channel, (C,), or per time point and channel, (T, C) for TCYX
+    :param bt_array: bleed-through matrix, see `subtract_bt`; only the top-left CxC block is used
+    :param cfp_index: channel index of the ratio denominator
+    :param fret_index: channel index of the ratio numerator
+    :param g: G factor, Eapp = ratio / (ratio + G)
+    :param corrected: array for the corrected channels, same shape as multi_channel, e.g. uint16
+                      (values are clipped at 0 and cast as with astype). None for a new float32 array.
+    :param ratio: optional (Y, X) or (T, Y, X) float32 array for the ratio image
+    :param eapp: optional (Y, X) or (T, Y, X) float32 array for the Eapp image (needs g)
+    :param block_size: number of pixels per block
+    :param unmix: correct bleed-through by exact unmixing (`unmixing_matrix`) instead of `subtract_bt`
+    :return: corrected, ratio, eapp
+    """
+    num_channel = multi_channel.shape[-3]
+    if unmix:
+        matrix = unmixing_matrix(bt_array, num_channel)
+    else:
+        matrix = bt_correction_matrix(bt_array, num_channel)
+    bg = np.asarray(bg_mean_list, dtype='float32')
+    if bg.shape not in ((num_channel,), tuple(multi_channel.shape[:-2])):
+        raise ValueError("bg_mean_list has to be (C,) or, for TCYX, (T, C); got %s" % (bg.shape,))
+    bg = bg.reshape(-1, num_channel, 1)
+    if corrected is None:
+        corrected = np.empty(multi_channel.shape, dtype='float32')
+    outputs = [corrected, ratio, eapp]
+    if len(multi_channel.shape) == 3:
+        frames = np.asarray(multi_channel)[np.newaxis]
+        outputs = [None if a is None else a[np.newaxis] for a in outputs]
+    else:
+        frames = multi_channel
+    size = frames.shape[2] * frames.shape[3]
+    outputs = [None if a is None else a.reshape((len(frames), -1, size)) for a in outputs]
+    for a, given in zip(outputs, (corrected, ratio, eapp)):
+        if a is not None and not np.shares_memory(a, given):
+            raise ValueError("output arrays have to be C-contiguous")
+    (out_corrected, out_ratio, out_eapp) = outputs
+    for t in range(len(frames)):
+        frame = np.asarray(frames[t]).reshape(num_channel, size)
+        frame_bg = bg[t] if len(bg) > 1 else bg[0]
+        kernels.fret_frame(frame, frame_bg, matrix, cfp_index, fret_index, g, out_corrected[t],
+                           None if out_ratio is None else out_ratio[t, 0],
+                           None if out_eapp is None else out_eapp[t, 0], block_size)
+    return corrected, ratio, eapp
 
 
 class BleedThroughChart(tk.Frame):
@@ -35,4 +35,7 @@ print("cell ROI values are:\n", cell_list)
 show_all_channels_with_roi2(newImg, cell_rois)
 slopes, rsqs = get_slope(cell_list)
 print("slope\t from {rows} | to {columns} \n", slopes)
-print("r-value\t from {rows} | to {columns} \n", rsqs)
\ No newline at end of file
+print("r-value\t from {rows} | to {columns} \n", rsqs)
+(_, slope_low, slope_high) = bootstrap_coefficients(cell_list)
+print("95% confidence interval of the slopes, lower bound\n", slope_low)
+print("95% confidence interval of the slopes, upper bound\n", slope_high)
\ No newline at end of file
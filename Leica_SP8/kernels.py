@@ -0,0 +1,238 @@
+"""
+kernels.py  -- per-pixel FRET arithmetic (background clip, bleed-through, ratio, Eapp) with a pluggable backend
+'numba': one multithreaded loop over the pixels of a frame, no temporaries
+'numexpr': multithreaded element-wise expressions over blocks of pixels
+'numpy': NumPy over blocks of pixels, always available
+The default is the first installed of numba, numexpr, numpy. Choose it with `set_backend`, or with
+the MSR_BACKEND environment variable. All backends give the same results to float32 tolerance.
+required packages: numpy; optional: numba, numexpr
+"""
+import numpy as np
+import os
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numba', 'numexpr', 'numpy')
+
+
+def available_backends():
+    """
+    :return: list of the backends that can be used here
+    """
+    return [name for name, module in zip(BACKENDS, (numba, numexpr, np)) if module is not None]
+
+
+def set_backend(name='auto'):
+    """
+    Choose the compute backend
+    :param name: 'numba', 'numexpr', 'numpy', or 'auto' for the first available one
+    :return: name of the backend in use
+    """
+    global _backend
+    if name == 'auto':
+        name = available_backends()[0]
+    if name not in BACKENDS:
+        raise ValueError("backend has to be one of %s or 'auto'" % (BACKENDS,))
+    if name not in available_backends():
+        raise ImportError("backend %s is not installed" % name)
+    _backend = name
+    return _backend
+
+
+def get_backend():
+    return _backend
+
+
+########################## numpy
+
+
+def _contract_numpy(frame, matrix, out, block_size):
+    buffer = np.empty((len(matrix), min(block_size, frame.shape[1])), dtype='float32')
+    for start in range(0, frame.shape[1], block_size):
+        block = slice(start, start + block_size)
+        result = buffer[:, :min(block_size, frame.shape[1] - start)]
+        np.matmul(matrix, frame[:, block], out=result)
+        out[:, block] = result
+
+
+def _fret_numpy(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio, eapp, block_size):
+    (num_channel, size) = frame.shape
+    subtracted = np.empty((num_channel, min(block_size, size)), dtype='float32')
+    result = np.empty_like(subtracted)
+    quotient = np.empty(subtracted.shape[1], dtype='float32')
+    denominator = np.empty_like(quotient)
+    for start in range(0, size, block_size):
+        block = slice(start, start + block_size)
+        n = min(block_size, size - start)
+        np.subtract(frame[:, block], bg, out=subtracted[:, :n])
+        np.maximum(subtracted[:, :n], 0, out=subtracted[:, :n])
+        np.matmul(matrix, subtracted[:, :n], out=result[:, :n])
+        if ratio is not None or eapp is not None:
+            q = quotient[:n]
+            q[:] = 0
+            np.divide(result[fret_index, :n], result[cfp_index, :n], out=q, where=result[cfp_index, :n] != 0)
+            np.maximum(q, 0, out=q)
+            if ratio is not None:
+                ratio[block] = q
+            if eapp is not None:
+                # 0 where ratio + G is 0 (G = 0 and ratio 0)
+                d = denominator[:n]
+                np.add(q, g, out=d)
+                e = eapp[block]
+                e[:] = 0
+                np.divide(q, d, out=e, where=d != 0)
+        np.maximum(result[:, :n], 0, out=result[:, :n])
+        corrected[:, block] = result[:, :n]
+
+
+########################## numexpr
+
+
+def _numexpr_block(frame, block):
+    # numexpr has no unsigned integer types
+    values = frame[:, block]
+    return values if values.dtype.kind == 'f' else values.astype('float32')
+
+
+def _contract_numexpr(frame, matrix, out, block_size):
+    (num_channel, size) = frame.shape
+    expression = '+'.join('m%d*x%d' % (i, i) for i in range(num_channel))
+    result = np.empty((num_channel, min(block_size, size)), dtype='float32')
+    for start in range(0, size, block_size):
+        block = slice(start, start + block_size)
+        n = min(block_size, size - start)
+        values = _numexpr_block(frame, block)
+        local = dict(('x%d' % i, values[i]) for i in range(num_channel))
+        for j in range(num_channel):
+            local.update(('m%d' % i, np.float32(matrix[j, i])) for i in range(num_channel))
+            numexpr.evaluate(expression, local_dict=local, out=result[j, :n], casting='same_kind')
+        out[:, block] = result[:, :n]
+
+
+def _fret_numexpr(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio, eapp, block_size):
+    (num_channel, size) = frame.shape
+    subtracted = np.empty((num_channel, min(block_size, size)), dtype='float32')
+    result = np.empty_like(subtracted)
+    quotient = np.empty(result.shape[1], dtype='float32')
+    expression = '+'.join('m%d*x%d' % (i, i) for i in range(num_channel))
+    for start in range(0, size, block_size):
+        block = slice(start, start + block_size)
+        n = min(block_size, size - start)
+        values = _numexpr_block(frame, block)
+        local = {}
+        for i in range(num_channel):
+            numexpr.evaluate('where(x > b, x - b, 0)', local_dict={'x': values[i], 'b': np.float32(bg[i, 0])},
+                             out=subtracted[i, :n], casting='same_kind')
+            local['x%d' % i] = subtracted[i, :n]
+        for j in range(num_channel):
+            local.update(('m%d' % i, np.float32(matrix[j, i])) for i in range(num_channel))
+            numexpr.evaluate(expression, local_dict=local, out=result[j, :n], casting='same_kind')
+        if ratio is not None or eapp is not None:
+            q = quotient[:n]
+            local = {'f': result[fret_index, :n], 'c': result[cfp_index, :n], 'g': np.float32(g)}
+            numexpr.evaluate('where(c != 0, f / c, 0)', local_dict=local, out=q, casting='same_kind')
+            numexpr.evaluate('where(q > 0, q, 0)', local_dict={'q': q}, out=q, casting='same_kind')
+            if ratio is not None:
+                ratio[block] = q
+            if eapp is not None:
+                numexpr.evaluate('where(q + g != 0, q / (q + g), 0)', local_dict={'q': q, 'g': np.float32(g)},
+                                 out=eapp[block], casting='same_kind')
+        for j in range(num_channel):
+            numexpr.evaluate('where(r > 0, r, 0)', local_dict={'r': result[j, :n]}, out=result[j, :n],
+                             casting='same_kind')
+        corrected[:, block] = result[:, :n]
+
+
+########################## numba
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _contract_numba(frame, matrix, out, block_size):
+        (num_channel, size) = frame.shape
+        for b in numba.prange((size + block_size - 1) // block_size):
+            start = b * block_size
+            stop = min(start + block_size, size)
+            # all channels of a block are computed before writing, so that out may be frame
+            result = np.empty((num_channel, stop - start), dtype=np.float32)
+            for p in range(start, stop):
+                for j in range(num_channel):
+                    value = np.float32(0)
+                    for i in range(num_channel):
+                        value += matrix[j, i] * np.float32(frame[i, p])
+                    result[j, p - start] = value
+            out[:, start:stop] = result
+
+    @numba.njit(parallel=True, cache=True)
+    def _fret_numba(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio, eapp, do_ratio, do_eapp):
+        (num_channel, size) = frame.shape
+        for p in numba.prange(size):
+            cfp = np.float32(0)
+            fret = np.float32(0)
+            for j in range(num_channel):
+                value = np.float32(0)
+                for i in range(num_channel):
+                    value += matrix[j, i] * max(np.float32(frame[i, p]) - bg[i, 0], np.float32(0))
+                if j == cfp_index:
+                    cfp = value
+                if j == fret_index:
+                    fret = value
+                corrected[j, p] = max(value, np.float32(0))
+            if do_ratio or do_eapp:
+                q = np.float32(0)
+                if cfp != 0:
+                    q = max(fret / cfp, np.float32(0))
+                if do_ratio:
+                    ratio[p] = q
+                if do_eapp:
+                    eapp[p] = q / (q + g) if q + g != 0 else np.float32(0)
+
+
+########################## dispatch
+
+
+def contract_frame(frame, matrix, out, block_size=65536):
+    """
+    out = matrix @ frame, e.g. the bleed-through correction of one frame
+    :param frame: (C, N) np.array, the pixels of one frame
+    :param matrix: (C, C) float32 np.array
+    :param out: (C, N) array to write into, may be frame itself
+    """
+    if _backend == 'numba':
+        _contract_numba(frame, matrix, out, block_size)
+    elif _backend == 'numexpr':
+        _contract_numexpr(frame, matrix, out, block_size)
+    else:
+        _contract_numpy(frame, matrix, out, block_size)
+
+
+def fret_frame(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio=None, eapp=None, block_size=65536):
+    """
+    Background subtraction, clip, bleed-through correction, ratio, Eapp and clip of one frame
+    :param frame: (C, N) np.array, the pixels of one frame, any dtype
+    :param bg: (C, 1) float32 background
+    :param matrix: (C, C) float32 bleed-through correction matrix
+    :param cfp_index, fret_index: channel indices of the ratio denominator and numerator
+    :param g: G factor
+    :param corrected: (C, N) array for the corrected channels, clipped at 0; not frame itself
+    :param ratio: optional (N,) float32 array for the ratio, 0 where the CFP value is 0
+    :param eapp: optional (N,) float32 array for Eapp, 0 where ratio + g is 0
+    """
+    if _backend == 'numba':
+        empty = np.zeros(0, dtype='float32')
+        _fret_numba(frame, bg, matrix, cfp_index, fret_index, np.float32(g), corrected,
+                    empty if ratio is None else ratio, empty if eapp is None else eapp,
+                    ratio is not None, eapp is not None)
+    elif _backend == 'numexpr':
+        _fret_numexpr(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio, eapp, block_size)
+    else:
+        _fret_numpy(frame, bg, matrix, cfp_index, fret_index, g, corrected, ratio, eapp, block_size)
+
+
+_backend = set_backend(os.environ.get('MSR_BACKEND', 'auto'))
@@ -0,0 +1,196 @@
+"""
+measurement_table.py  -- labelled, columnar measurement output replacing the np.savetxt csv dumps
+One row per value, with the columns file, roi, t, channel, statistic and value, written as
+Parquet or Feather when pyarrow is installed, as a compressed .npz otherwise, or as csv on request.
+String columns are dictionary encoded, so repeated file and statistic names cost almost nothing.
+required packages: numpy; optional: pyarrow
+"""
+import numpy as np
+import csv
+import os
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ('file', 'roi', 't', 'channel', 'statistic', 'value')
+FORMATS = ('parquet', 'feather', 'npz', 'csv')
+
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'npz'
+
+
+class measurementTable():
+    """
+    measurementTable collects measurements of one or several files, then writes them in one go.
+    table = measurementTable()
+    table.add(imgStack.measure(cell_rois), file='cell1.czi')       # all statistics
+    table.add(bg_mean[np.newaxis], statistic='background', roi=0)  # plain (ROI, C) array
+    table.write('measurements')                                    # measurements.parquet / .npz
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def add(self, values, statistic='mean', file='', roi=None, t=None):
+        """
+        Add measurements.
+        :param values: structured np.array from `measure_rois` / `measure_labels` / imageStack.measure
+                       (one statistic per field), or a plain np.array; both (ROI, C) or (ROI, T, C)
+        :param statistic: name of the statistic of a plain array
+        :param file: name of the measured file
+        :param roi: ROI numbers (ROI,), default 1..ROI
+        :param t: time points (T,), default 0..T-1, or the time point of a (ROI, C) array
+        :return: self
+        """
+        values = np.asarray(values)
+        if values.ndim == 1:
+            values = values[np.newaxis]
+        if values.ndim == 2:
+            values = values[:, np.newaxis]
+        (num_roi, num_time, num_channel) = values.shape
+        roi = np.arange(1, num_roi + 1) if roi is None else np.atleast_1d(roi)
+        t = np.arange(num_time) if t is None else np.atleast_1d(t)
+        (roi_grid, t_grid, channel_grid) = np.meshgrid(roi, t, np.arange(num_channel), indexing='ij')
+        names = values.dtype.names or (None,)
+        for name in names:
+            column = values[name] if name else values
+            self._parts.append({'file': (file, column.size), 'roi': roi_grid.ravel(), 't': t_grid.ravel(),
+                                'channel': channel_grid.ravel(), 'statistic': (name or statistic, column.size),
+                                'value': column.astype('float64').ravel()})
+        return self
+
+    def _encoded_columns(self):
+        """
+        :return: dict of 1d np.arrays, with the string columns as (categories, int32 codes)
+        """
+        columns = {}
+        for name in COLUMNS:
+            if name in ('file', 'statistic'):
+                categories = sorted(set(part[name][0] for part in self._parts))
+                codes = [np.full(part[name][1], categories.index(part[name][0]), dtype='int32')
+                         for part in self._parts]
+                columns[name] = (np.array(categories, dtype=str),
+                                 np.concatenate(codes) if codes else np.zeros(0, dtype='int32'))
+            else:
+                parts = [part[name] for part in self._parts]
+                dtype = 'float64' if name == 'value' else 'int32'
+                columns[name] = np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+        return columns
+
+    def columns(self):
+        """
+        :return: dict of 1d np.arrays, one per column in COLUMNS
+        """
+        return dict((name, column[0][column[1]] if isinstance(column, tuple) else column)
+                    for name, column in self._encoded_columns().items())
+
+    def write(self, file_path, file_format=None):
+        """
+        Write the table, see `write_table`
+        """
+        return _write_encoded(file_path, self._encoded_columns(), file_format)
+
+
+def write_table(file_path, columns, file_format=None):
+    """
+    Write a table of columns.
+    :param file_path: path of the output file. The extension is added if missing.
+    :param columns: dict of 1d np.arrays of the same length, e.g. measurementTable.columns()
+    :param file_format: 'parquet', 'feather', 'npz' or 'csv'. None: from the extension of file_path,
+                        else parquet when pyarrow is installed, npz otherwise.
+    :return: path of the written file
+    """
+    encoded = {}
+    for name, column in columns.items():
+        column = np.asarray(column)
+        if column.dtype.kind == 'U':
+            (categories, codes) = np.unique(column, return_inverse=True)
+            column = (categories, codes.astype('int32'))
+        encoded[name] = column
+    return _write_encoded(file_path, encoded, file_format)
+
+
+def _write_encoded(file_path, columns, file_format=None):
+    """
+    `write_table` for columns whose string columns are already (categories, codes)
+    """
+    (base, ext) = os.path.splitext(file_path)
+    if file_format is None:
+        file_format = ext.lstrip('.') if ext.lstrip('.') in FORMATS else default_format()
+    if file_format not in FORMATS:
+        raise ValueError("file_format has to be one of %s" % (FORMATS,))
+    if ext.lstrip('.') != file_format:
+        file_path = file_path + '.' + file_format
+    if file_format in ('parquet', 'feather'):
+        if pyarrow is None:
+            raise ImportError("writing %s needs pyarrow, use 'npz' or 'csv' instead" % file_format)
+        arrays = {}
+        for name, column in columns.items():
+            if isinstance(column, tuple):
+                arrays[name] = pyarrow.DictionaryArray.from_arrays(column[1], column[0].tolist())
+            else:
+                arrays[name] = pyarrow.array(column)
+        table = pyarrow.table(arrays)
+        if file_format == 'parquet':
+            pyarrow.parquet.write_table(table, file_path, compression='zstd')
+        else:
+            pyarrow.feather.write_feather(table, file_path, compression='zstd')
+    elif file_format == 'npz':
+        # keys are prefixed, 'file' would clash with the first argument of np.savez_compressed
+        data = {}
+        for name, column in columns.items():
+            if isinstance(column, tuple):
+                (data['categories_' + name], data['column_' + name]) = column
+            else:
+                data['column_' + name] = column
+        np.savez_compressed(file_path, **data)
+    else:
+        with open(file_path, 'w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*[(column[0][column[1]] if isinstance(column, tuple) else column).tolist()
+                                   for column in columns.values()]))
+    return file_path
+
+
+def read_table(file_path):
+    """
+    Read a table written by `write_table`
+    :param file_path: path of a .parquet, .feather, .npz or .csv file
+    :return: dict of 1d np.arrays
+    """
+    ext = os.path.splitext(file_path)[1].lstrip('.')
+    if ext in ('parquet', 'feather'):
+        if pyarrow is None:
+            raise ImportError("reading %s needs pyarrow" % ext)
+        table = pyarrow.parquet.read_table(file_path) if ext == 'parquet' else pyarrow.feather.read_table(file_path)
+        return dict((name, np.asarray(table[name].to_pylist() if pyarrow.types.is_dictionary(table[name].type)
+                                      else table[name].to_numpy())) for name in table.column_names)
+    if ext == 'npz':
+        with np.load(file_path) as data:
+            columns = {}
+            for key in data.files:
+                if key.startswith('column_'):
+                    name = key[len('column_'):]
+                    columns[name] = data[key]
+                    if 'categories_' + name in data.files:
+                        columns[name] = data['categories_' + name][columns[name]]
+        return columns
+    with open(file_path, newline='') as fh:
+        reader = csv.reader(fh)
+        names = next(reader)
+        values = list(zip(*reader)) or [()] * len(names)
+    columns = {}
+    for name, column in zip(names, values):
+        for dtype in ('int64', 'float64', str):
+            try:
+                columns[name] = np.array(column, dtype=dtype)
+                break
+            except ValueError:
+                continue
+    return columns
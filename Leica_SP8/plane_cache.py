@@ -0,0 +1,108 @@
+"""
+plane_cache.py  -- opt-in on-disk cache of decoded image data
+Decoded arrays are stored as memory-mappable .npy files, keyed by a fingerprint of the file content
+plus the reader and its parameters, with least-recently-used eviction under a size cap.
+Enable it by setting the MSR_CACHE_DIR environment variable (and optionally MSR_CACHE_MAX_GB),
+or by passing cache_dir to `cached_load`.
+required packages: numpy
+"""
+import numpy as np
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.environ.get('MSR_CACHE_DIR')
+CACHE_MAX_BYTES = int(float(os.environ.get('MSR_CACHE_MAX_GB', 20)) * 2 ** 30)
+
+
+def file_fingerprint(file_path, full_hash=False, block_size=2 ** 20, num_blocks=16):
+    """
+    Hash the content of a file. By default only the size and `num_blocks` evenly spaced blocks are
+    hashed, which is fast on multi-GB files and still changes when the acquisition is rewritten.
+    :param file_path: path of the file
+    :param full_hash: True to hash the whole file
+    :param block_size: size of one sampled block in bytes
+    :param num_blocks: number of sampled blocks
+    :return: hex digest
+    """
+    size = os.path.getsize(file_path)
+    h = hashlib.sha1(str(size).encode())
+    with open(file_path, 'rb') as fh:
+        if full_hash or size <= block_size * num_blocks:
+            for block in iter(lambda: fh.read(block_size), b''):
+                h.update(block)
+        else:
+            for offset in np.linspace(0, size - block_size, num_blocks).astype('int64'):
+                fh.seek(int(offset))
+                h.update(fh.read(block_size))
+    return h.hexdigest()
+
+
+def cache_key(file_path, reader, params, full_hash=False):
+    """
+    Key of a decoded array: file content fingerprint + reader name + reader parameters
+    """
+    name = '%s.%s' % (reader.__module__, reader.__name__)
+    text = json.dumps([file_fingerprint(file_path, full_hash), name, params], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """
+    Remove the least recently used entries until the cache is below max_bytes
+    :return: number of removed entries
+    """
+    # other processes sharing the cache may remove entries at any time
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                continue
+    entries.sort()
+    total = sum(size for (_, size, _) in entries)
+    removed = 0
+    for (_, size, path) in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
+
+
+def cached_load(file_path, reader, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, full_hash=False, **params):
+    """
+    Return reader(file_path, **params), from the cache when the same file was decoded before
+    with the same reader and parameters. With a cache the data always comes back as a read-only np.memmap.
+    :param file_path: path of the image file
+    :param reader: function returning a np.array, e.g. read_czi_channels
+    :param cache_dir: cache directory. None disables the cache.
+    :param max_bytes: size cap of the cache directory
+    :param full_hash: hash the whole file instead of sampled blocks
+    :param params: keyword parameters passed to reader
+    :return: np.array
+    """
+    if not cache_dir:
+        return reader(file_path, **params)
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_key(file_path, reader, params, full_hash) + '.npy')
+    try:
+        os.utime(path)
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+    data = np.asarray(reader(file_path, **params))
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as fh:
+        np.save(fh, data)
+    # the first load returns a read-only memmap too, mapped before eviction may remove the entry
+    data = np.load(temp_path, mmap_mode='r')
+    os.replace(temp_path, path)
+    evict(cache_dir, max_bytes)
+    return data
@@ -0,0 +1,454 @@
+"""
+roi_measure.py  -- vectorized ROI measurement on image stacks
+ROIs are rasterized once, inside their bounding boxes, and grouped into flat pixel indices (or taken
+from label images); all statistics are then reduced per ROI for every plane after one gather of
+the ROI pixels, instead of building one full-frame mask per ROI per plane.
+Masks follow roipoly: a pixel belongs to a ROI when its center is inside the polygon.
+Masks and pixel groups are cached on the ROI object per frame shape, and rebuilt when its polygons change.
+required packages: matplotlib, numpy
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+import os
+from matplotlib.path import Path as MplPath
+
+
+def roi_polygons(multi_roi):
+    """
+    Get the polygons of a roipoly MultiRoi.
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :return: list of ROI names, list of (N, 2) arrays of (x, y) vertices
+    """
+    names, polygons = [], []
+    for name, roi in multi_roi.rois.items():
+        names.append(name)
+        polygons.append(np.column_stack((roi.x, roi.y)).astype('float64'))
+    return names, polygons
+
+
+def rasterize_polygon(vertices, shape):
+    """
+    Rasterize one polygon the way roipoly's get_mask does, testing only the pixels in its bounding box.
+    :param vertices: (N, 2) array of (x, y) vertices
+    :param shape: (Y, X) shape of the frame
+    :return: (slice_y, slice_x) of the bounding box, 2d bool mask of the bounding box
+    """
+    (ny, nx) = shape
+    x0 = int(min(max(np.floor(vertices[:, 0].min()), 0), nx))
+    x1 = int(min(max(np.ceil(vertices[:, 0].max()) + 1, 0), nx))
+    y0 = int(min(max(np.floor(vertices[:, 1].min()), 0), ny))
+    y1 = int(min(max(np.ceil(vertices[:, 1].max()) + 1, 0), ny))
+    # same vertex order as roipoly.RoiPoly.get_mask, so pixels on the edge are decided the same way
+    poly_verts = np.vstack((vertices[:1], vertices[::-1]))
+    (x, y) = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+    points = np.column_stack((x.ravel(), y.ravel()))
+    mask = MplPath(poly_verts).contains_points(points).reshape((y1 - y0, x1 - x0))
+    return (slice(y0, y1), slice(x0, x1)), mask
+
+
+def roi_masks(polygons, shape):
+    """
+    Rasterize polygons into bounding boxes with cropped masks. Memory and measurement cost scale
+    with the ROI area, not with the frame size.
+    :param polygons: list of (N, 2) arrays of (x, y) vertices
+    :param shape: (Y, X) shape of the frame
+    :return: list of ((slice_y, slice_x), 2d bool mask of the bounding box)
+    """
+    return [rasterize_polygon(vertices, shape) for vertices in polygons]
+
+
+def mask_pixel_groups(masks, shape):
+    """
+    Flat pixel indices of bounding-box masks, grouped by ROI, without any full-frame array.
+    Overlapping ROIs simply share pixels.
+    :param masks: list of (box, mask) from `roi_masks`
+    :param shape: (Y, X) shape of the frame
+    :return: pixel index (N,), start of every ROI in the index (ROI,), pixel count (ROI,)
+    """
+    nx = shape[1]
+    index_list = []
+    for ((slice_y, slice_x), mask) in masks:
+        (yy, xx) = np.nonzero(mask)
+        index_list.append((yy + slice_y.start) * nx + (xx + slice_x.start))
+    count = np.array([len(index) for index in index_list], dtype='intp')
+    starts = np.concatenate(([0], np.cumsum(count)[:-1])).astype('intp')
+    index = np.concatenate(index_list).astype('intp') if index_list else np.zeros(0, dtype='intp')
+    return index, starts, count
+
+
+def label_layers(polygons, shape):
+    """
+    Rasterize all polygons into label images: 0 is background, i + 1 is polygon i.
+    A polygon that overlaps an earlier one goes to another layer, so every pixel of every ROI is
+    counted like with roipoly. Usually there is only one layer.
+    :param polygons: list of (N, 2) arrays of (x, y) vertices
+    :param shape: (Y, X) shape of the frame
+    :return: list of 2d int32 label images
+    """
+    # measure_rois uses the sparse `roi_masks` instead; label images are for label-based workflows
+    layers = []
+    for i, vertices in enumerate(polygons):
+        (box, mask) = rasterize_polygon(vertices, shape)
+        for layer in layers:
+            if not layer[box][mask].any():
+                break
+        else:
+            layer = np.zeros(shape, dtype='int32')
+            layers.append(layer)
+        layer[box][mask] = i + 1
+    return layers
+
+
+def _iter_planes(stack):
+    """
+    Generator over the YX planes of an array or npyStore in C order, one chunk of the first axis at a time
+    """
+    (ny, nx) = stack.shape[-2:]
+    if len(stack.shape) == 2:
+        yield np.asarray(stack)
+        return
+    for chunk in stack:
+        for plane in np.reshape(chunk, (-1, ny, nx)):
+            yield plane
+
+
+def roi_pixel_groups(layers, num_roi):
+    """
+    Flat pixel indices of all ROIs, grouped by ROI, so that statistics can be reduced per ROI with
+    np.ufunc.reduceat after one gather per plane.
+    :param layers: label images from `label_layers`
+    :param num_roi: number of ROIs
+    :return: pixel index (N,), start of every ROI in the index (ROI,), pixel count (ROI,)
+    """
+    index_list, label_list = [], []
+    for layer in layers:
+        flat = layer.ravel()
+        nonzero = np.flatnonzero(flat)
+        index_list.append(nonzero)
+        label_list.append(flat[nonzero])
+    index = np.concatenate(index_list) if index_list else np.zeros(0, dtype='intp')
+    labels = np.concatenate(label_list) if label_list else np.zeros(0, dtype='int32')
+    order = np.argsort(labels, kind='stable')
+    count = np.bincount(labels, minlength=num_roi + 1)[1:]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1])).astype('intp')
+    return index[order], starts, count
+
+
+STATISTICS = ('mean', 'std', 'min', 'max', 'sum', 'area')
+
+
+def measure_groups(stack, index, starts, count, percentiles=None):
+    """
+    All statistics of every pixel group in every plane of a stack, in one pass over the data.
+    :param stack: np.array or npyStore (..., Y, X)
+    :param index, starts, count: pixel groups from `roi_pixel_groups`
+    :param percentiles: optional list of percentiles (0-100), stored in fields 'p<q>', e.g. 'p50'
+    :return: structured np.array (ROI, ...) with fields mean, std, min, max, sum, area and
+             percentiles; ... is stack.shape[:-2]. ROIs without pixels are NaN.
+    """
+    percentiles = list(percentiles or [])
+    lead_shape = tuple(stack.shape[:-2])
+    num_roi = len(count)
+    fields = list(STATISTICS) + ['p%g' % q for q in percentiles]
+    result = np.full((int(np.prod(lead_shape)), num_roi), np.nan, dtype=[(name, 'f8') for name in fields])
+    valid = count > 0
+    (vstarts, vcount) = (starts[valid], count[valid])
+    if percentiles:
+        segment = np.repeat(np.arange(len(vcount)), vcount)
+    for p, plane in enumerate(_iter_planes(stack)):
+        if not len(vcount):
+            break
+        values = plane.ravel()[index].astype('float64')
+        total = np.add.reduceat(values, vstarts)
+        mean = total / vcount
+        row = result[p]
+        row['sum'][valid] = total
+        row['mean'][valid] = mean
+        row['std'][valid] = np.sqrt(np.maximum(np.add.reduceat(values * values, vstarts) / vcount - mean * mean, 0))
+        row['min'][valid] = np.minimum.reduceat(values, vstarts)
+        row['max'][valid] = np.maximum.reduceat(values, vstarts)
+        if percentiles:
+            values = values[np.lexsort((values, segment))]
+            for q in percentiles:
+                # linear interpolation between ranks, as np.percentile
+                position = q / 100. * (vcount - 1)
+                low = np.floor(position).astype('intp')
+                high = np.ceil(position).astype('intp')
+                frac = position - low
+                row['p%g' % q][valid] = values[vstarts + low] * (1 - frac) + values[vstarts + high] * frac
+    result['area'] = np.where(valid, count, np.nan)
+    return np.moveaxis(result, 0, -1).reshape((num_roi,) + lead_shape)
+
+
+def measure_rois(stack, multi_roi, percentiles=None):
+    """
+    Mean, std, min, max, integrated intensity (sum), pixel count (area) and optional percentiles
+    of every ROI in every plane of a stack, all from one pass over the data.
+    :param stack: np.array or npyStore (..., Y, X), e.g. (C, Y, X) or (T, C, Y, X)
+    :param multi_roi: ROI object obtained from `draw_roi2`, or a roiSet; masks are cached on it
+    :param percentiles: optional list of percentiles (0-100)
+    :return: structured np.array (ROI, ...), e.g. result['mean'] is (ROI, T, C) for a TCYX stack
+    """
+    (index, starts, count) = pixel_groups(multi_roi, stack.shape[-2:])
+    return measure_groups(stack, index, starts, count, percentiles)
+
+
+def pixel_groups(rois, shape):
+    """
+    Pixel groups of ROIs or of a label image, for `measure_groups`
+    :param rois: ROI object obtained from `draw_roi2`, a roiSet, or a 2d label image (0 is background)
+    :param shape: (Y, X) shape of the frame
+    :return: pixel index (N,), start of every ROI in the index (ROI,), pixel count (ROI,)
+    """
+    if isinstance(rois, np.ndarray):
+        return roi_pixel_groups([rois], int(rois.max(initial=0)))
+    return cached_masks(rois, shape)[1]
+
+
+def roi_signature(multi_roi):
+    """
+    Names and vertices of all ROIs, to detect that a ROI set changed
+    """
+    return tuple((name, tuple(roi.x), tuple(roi.y)) for name, roi in multi_roi.rois.items())
+
+
+def cached_masks(multi_roi, shape):
+    """
+    Masks and pixel groups of ROIs for a frame shape, cached on the ROI object (`_mask_cache`), so that
+    measuring the same ROIs on several stacks (corrected, raw, other excitation) rasterizes them once.
+    The cache entry is rebuilt when ROIs are added, removed or moved.
+    :param multi_roi: ROI object obtained from `draw_roi2`, or a roiSet
+    :param shape: (Y, X) shape of the frame
+    :return: list of (box, mask) from `roi_masks`, (index, starts, count) from `mask_pixel_groups`
+    """
+    shape = tuple(int(i) for i in shape)
+    signature = roi_signature(multi_roi)
+    cache = getattr(multi_roi, '_mask_cache', None)
+    if cache is None:
+        cache = {}
+        multi_roi._mask_cache = cache
+    entry = cache.get(shape)
+    if entry is None or entry[0] != signature:
+        masks = roi_masks(roi_polygons(multi_roi)[1], shape)
+        entry = (signature, masks, mask_pixel_groups(masks, shape))
+        cache[shape] = entry
+    return entry[1], entry[2]
+
+
+def measure_labels(stack, labels, percentiles=None):
+    """
+    Same statistics as `measure_rois`, for the objects of a label image, e.g. from `segment_stack`.
+    :param stack: np.array or npyStore (..., Y, X), e.g. (C, Y, X) or (T, C, Y, X)
+    :param labels: 2d int label image (Y, X), 0 is background. Row i of the result is label i + 1.
+    :param percentiles: optional list of percentiles (0-100)
+    :return: structured np.array (label, ...), e.g. result['mean'] is (label, T, C) for a TCYX stack
+    """
+    labels = np.asarray(labels)
+    (index, starts, count) = roi_pixel_groups([labels], int(labels.max(initial=0)))
+    return measure_groups(stack, index, starts, count, percentiles)
+
+
+def iter_measure_frames(frames, rois, percentiles=None, start=0):
+    """
+    Measure a time-lapse frame by frame while the frames are read, e.g. from an npyStore, a
+    memory-mapped stack or any generator of (C, Y, X) frames. ROIs are rasterized once.
+    :param frames: (T, C, Y, X) np.array / npyStore, or an iterable of (C, Y, X) frames
+    :param rois: ROI object obtained from `draw_roi2`, a roiSet, or a 2d label image
+    :param percentiles: optional list of percentiles (0-100)
+    :param start: first frame to measure, e.g. to resume an interrupted run
+    :return: yields (t, structured np.array (ROI, C)), see `measure_groups`
+    """
+    if hasattr(frames, '__len__') and hasattr(frames, '__getitem__'):
+        source = ((t, frames[t]) for t in range(start, len(frames)))
+    else:
+        source = ((t, frame) for (t, frame) in enumerate(frames) if t >= start)
+    groups = None
+    for t, frame in source:
+        frame = np.asarray(frame)
+        if groups is None:
+            groups = pixel_groups(rois, frame.shape[-2:])
+        yield t, measure_groups(frame, *groups, percentiles=percentiles)
+
+
+def _drop_last_csv_frame(file_path):
+    """
+    Remove the rows of the last frame of a csv written by `measure_frames_to_csv`, which are incomplete
+    when a run was interrupted while writing them, and any partial last line.
+    :return: t of the removed frame, to measure it again; 0 if the file has no rows
+    """
+    if not os.path.exists(file_path):
+        return 0
+    (last_t, last_offset, offset) = (None, 0, 0)
+    with open(file_path, 'rb') as fh:
+        for line in fh:
+            if not line.endswith(b'\n'):
+                break
+            if line.strip() and not line.startswith(b't,'):
+                t = int(float(line.split(b',')[0]))
+                if t != last_t:
+                    (last_t, last_offset) = (t, offset)
+            offset += len(line)
+    if last_t is None:
+        last_offset = offset
+    with open(file_path, 'r+b') as fh:
+        fh.truncate(last_offset)
+    return 0 if last_t is None else last_t
+
+
+def measure_frames_to_csv(file_path, frames, rois, percentiles=None, resume=True):
+    """
+    Measure a time-lapse frame by frame and append one row per (t, roi, channel) to a csv file,
+    flushed after every frame, so memory stays constant and results survive an interruption.
+    Columns: t, roi (1..ROI, the label for label images), channel, mean, std, min, max, sum, area, p<q>...
+    :param file_path: path of the csv file
+    :param frames: (T, C, Y, X) np.array / npyStore, or an iterable of (C, Y, X) frames
+    :param rois: ROI object obtained from `draw_roi2`, a roiSet, or a 2d label image
+    :param percentiles: optional list of percentiles (0-100)
+    :param resume: continue an interrupted run instead of overwriting the file. The last frame in the
+                   file, possibly written only in part, is measured again.
+    :return: number of frames measured
+    """
+    start = _drop_last_csv_frame(file_path) if resume else 0
+    measured = 0
+    with open(file_path, 'a' if resume else 'w') as fh:
+        for t, result in iter_measure_frames(frames, rois, percentiles, start):
+            (num_roi, num_channel) = result.shape
+            if fh.tell() == 0:
+                fh.write(','.join(('t', 'roi', 'channel') + result.dtype.names) + '\n')
+            (roi, channel) = np.meshgrid(np.arange(1, num_roi + 1), np.arange(num_channel), indexing='ij')
+            table = np.column_stack([np.full(result.size, t), roi.ravel(), channel.ravel()] +
+                                    [result[name].ravel() for name in result.dtype.names])
+            np.savetxt(fh, table, fmt=['%d', '%d', '%d'] + ['%.7g'] * len(result.dtype.names), delimiter=',')
+            fh.flush()
+            measured += 1
+    return measured
+
+
+def roi_mean_std(stack, multi_roi):
+    """
+    Mean and standard deviation of every ROI in every plane of a stack, same values as roipoly's
+    get_mean_and_std, with all ROIs rasterized once.
+    :param stack: np.array or npyStore (..., Y, X), e.g. (C, Y, X) or (T, C, Y, X)
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :return: mean, std; np.array (ROI, ...) where ... is stack.shape[:-2]
+    """
+    result = measure_rois(stack, multi_roi)
+    return result['mean'], result['std']
+
+
+class polygonRoi():
+    """
+    polygonRoi is a polygon ROI without GUI, with the geometry and display methods of roipoly's RoiPoly.
+    """
+
+    def __init__(self, x, y, color='b'):
+        self.x = list(x)
+        self.y = list(y)
+        self.color = color
+
+    def get_mask(self, current_image):
+        shape = np.shape(current_image)
+        (box, mask) = rasterize_polygon(np.column_stack((self.x, self.y)).astype('float64'), shape)
+        grid = np.zeros(shape, dtype=bool)
+        grid[box] = mask
+        return grid
+
+    def get_mean_and_std(self, current_image):
+        values = np.asarray(current_image)[self.get_mask(current_image)]
+        return np.mean(values), np.std(values)
+
+    def display_roi(self, **linekwargs):
+        line = plt.Line2D(self.x + [self.x[0]], self.y + [self.y[0]], color=self.color, **linekwargs)
+        ax = plt.gca()
+        ax.add_line(line)
+        plt.draw()
+
+    def display_mean(self, current_image, **textkwargs):
+        mean, std = self.get_mean_and_std(current_image)
+        string = "%.3f +- %.3f" % (mean, std)
+        plt.text(self.x[0], self.y[0], string, color=self.color,
+                 bbox=dict(facecolor='w', alpha=0.6), **textkwargs)
+
+
+class roiSet():
+    """
+    roiSet is a set of named polygonRoi that can be used wherever a MultiRoi from `draw_roi2` is
+    expected (`.rois` dict), without GUI. Rasterized masks are cached per frame shape, see `cached_masks`.
+    """
+
+    def __init__(self, rois=None):
+        """
+        :param rois: dict or list of (name, polygonRoi)
+        """
+        self.rois = dict(rois or {})
+        self._mask_cache = {}
+
+    def get_masks(self, shape):
+        """
+        Bounding-box masks of all ROIs for a frame shape, see `roi_masks`. Rasterized once per shape.
+        :param shape: (Y, X) shape of the frame
+        :return: list of ((slice_y, slice_x), 2d bool mask)
+        """
+        return cached_masks(self, shape)[0]
+
+
+def as_roi_set(multi_roi):
+    """
+    Copy the polygons of a MultiRoi (or roiSet) into a new roiSet
+    """
+    rois = []
+    for name, roi in multi_roi.rois.items():
+        rois.append((str(name), polygonRoi(roi.x, roi.y, getattr(roi, 'color', 'b'))))
+    return roiSet(rois)
+
+
+def save_rois(file_path, multi_roi, shape=None):
+    """
+    Save ROIs to a compressed .npz file: polygon vertices, plus the rasterized bounding-box masks of
+    every frame shape cached on the set (and of `shape`), so that reloading needs no rasterization.
+    :param file_path: path of the .npz file
+    :param multi_roi: ROI object obtained from `draw_roi2`, or a roiSet
+    :param shape: optional (Y, X) frame shape whose masks are saved too
+    :return: file_path
+    """
+    roi_set = multi_roi if isinstance(multi_roi, roiSet) else as_roi_set(multi_roi)
+    (names, polygons) = roi_polygons(roi_set)
+    data = {'names': np.array(names, dtype=str),
+            'colors': np.array([str(roi.color) for roi in roi_set.rois.values()], dtype=str),
+            'num_vertex': np.array([len(vertices) for vertices in polygons], dtype='int64'),
+            'vertices': np.concatenate(polygons) if polygons else np.zeros((0, 2))}
+    shapes = set(roi_set._mask_cache)
+    if shape is not None:
+        shapes.add(tuple(int(i) for i in shape))
+    for k, mask_shape in enumerate(sorted(shapes)):
+        masks = roi_set.get_masks(mask_shape)
+        data['mask%d_shape' % k] = np.array(mask_shape)
+        data['mask%d_box' % k] = np.array([[sy.start, sy.stop, sx.start, sx.stop]
+                                           for ((sy, sx), mask) in masks], dtype='int64').reshape(-1, 4)
+        data['mask%d_bits' % k] = np.packbits(np.concatenate([mask.ravel() for (box, mask) in masks] + [[]]).astype(bool))
+    np.savez_compressed(file_path, **data)
+    return file_path
+
+
+def load_rois(file_path):
+    """
+    Load ROIs saved by `save_rois`, with their cached masks.
+    :param file_path: path of the .npz file
+    :return: roiSet, usable in get_intensity_list / imageStack.get_intensity_list
+    """
+    with np.load(file_path) as data:
+        polygons = np.split(data['vertices'], np.cumsum(data['num_vertex'])[:-1])
+        roi_set = roiSet((str(name), polygonRoi(vertices[:, 0], vertices[:, 1], str(color)))
+                         for name, color, vertices in zip(data['names'], data['colors'], polygons))
+        k = 0
+        while 'mask%d_shape' % k in data:
+            boxes = data['mask%d_box' % k]
+            sizes = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+            bits = np.unpackbits(data['mask%d_bits' % k], count=int(sizes.sum())).astype(bool)
+            masks = []
+            for (y0, y1, x0, x1), mask in zip(boxes, np.split(bits, np.cumsum(sizes)[:-1])):
+                masks.append(((slice(int(y0), int(y1)), slice(int(x0), int(x1))), mask.reshape(y1 - y0, x1 - x0)))
+            shape = tuple(int(i) for i in data['mask%d_shape' % k])
+            roi_set._mask_cache[shape] = (roi_signature(roi_set), masks, mask_pixel_groups(masks, shape))
+            k += 1
+    return roi_set
@@ -0,0 +1,98 @@
+"""
+segmentation.py  -- automatic cell segmentation into label images, replacing cell ROIs drawn with draw_roi2
+threshold -> morphological cleanup -> connected-component labelling -> size filter.
+Labels are 1..N (0 is background) and feed straight into `roi_measure.measure_labels`.
+required packages: numpy, scipy
+"""
+import numpy as np
+from scipy import ndimage
+from background import plane_histograms, otsu_thresholds
+
+
+def segmentation_image(stack, channel=None, time=None):
+    """
+    The image to segment: one channel, or the sum projection of several channels (and time points).
+    :param stack: np.array, npyStore or imageStack, 'CYX' or 'TCYX'
+    :param channel: channel index or list of channel indices, None for all channels
+    :param time: time index for 'TCYX', None for the sum over all time points
+    :return: 2d float32 np.array
+    """
+    stack = getattr(stack, 'stack', stack)
+    channel = list(range(stack.shape[-3])) if channel is None else np.atleast_1d(channel)
+    image = np.zeros(stack.shape[-2:], dtype='float32')
+    if len(stack.shape) == 3:
+        for c in channel:
+            image += stack[c]
+        return image
+    for t in (range(len(stack)) if time is None else [time]):
+        frame = stack[t]
+        for c in channel:
+            image += frame[c]
+    return image
+
+
+def otsu_threshold(image, bins=256):
+    """
+    Otsu threshold of a 2d image
+    """
+    counts, low, width = plane_histograms(np.asarray(image, dtype='float32').reshape(1, -1), bins)
+    return float(otsu_thresholds(counts, low, width)[0, 0])
+
+
+def segment_cells(image, threshold='otsu', min_size=20, max_size=None, opening=1, closing=1,
+                  fill_holes=True, smooth=1.0):
+    """
+    Segment cells in a 2d image.
+    :param image: 2d np.array, e.g. from `segmentation_image`
+    :param threshold: 'otsu', or an intensity value. Pixels above it are foreground.
+    :param min_size: smallest object kept, in pixels
+    :param max_size: largest object kept, in pixels, None for no limit
+    :param opening: iterations of binary opening (removes specks and thin bridges between cells)
+    :param closing: iterations of binary closing (closes gaps in the cell outline)
+    :param fill_holes: fill holes inside objects (e.g. dark nuclei)
+    :param smooth: sigma of the gaussian filter applied before thresholding, 0 for none
+    :return: 2d int32 label image, 0 is background and objects are numbered 1..N
+    """
+    image = np.asarray(image, dtype='float32')
+    if smooth:
+        image = ndimage.gaussian_filter(image, smooth)
+    if threshold == 'otsu':
+        threshold = otsu_threshold(image)
+    mask = image > threshold
+    if closing:
+        mask = ndimage.binary_closing(mask, iterations=closing, border_value=0)
+    if opening:
+        mask = ndimage.binary_opening(mask, iterations=opening)
+    if fill_holes:
+        mask = ndimage.binary_fill_holes(mask)
+    (labels, num) = ndimage.label(mask)
+    return filter_labels(labels, min_size, max_size)
+
+
+def filter_labels(labels, min_size=0, max_size=None):
+    """
+    Remove objects outside [min_size, max_size] pixels and renumber the rest 1..N
+    :param labels: 2d label image
+    :return: 2d int32 label image
+    """
+    size = np.bincount(labels.ravel())
+    keep = size >= min_size
+    if max_size is not None:
+        keep &= size <= max_size
+    keep[0] = False
+    new_label = np.zeros(len(size), dtype='int32')
+    new_label[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return new_label[labels]
+
+
+def segment_stack(stack, channel=None, time=None, **kwargs):
+    """
+    Segment cells on one channel or a sum projection of an image stack.
+    labels = segment_stack(corrImg, channel=0, min_size=50); table = measure_labels(corrImg, labels)
+    :param stack: np.array, npyStore or imageStack, 'CYX' or 'TCYX'
+    :param channel: channel index or list of channel indices, None for all channels
+    :param time: time index for 'TCYX', None for the sum over all time points
+    :param kwargs: parameters of `segment_cells`
+    :return: 2d int32 label image
+    """
+    return segment_cells(segmentation_image(stack, channel, time), **kwargs)
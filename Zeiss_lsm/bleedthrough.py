@@ -9,29 +9,72 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 import czifile
 import matplotlib.pyplot as plt
 import numpy as np
+from functools import lru_cache
 # import Tkinter as tk      #using python2
 import tkinter as tk  # using python2
 # import tkFileDialog       #using python2
 import tkinter.filedialog as tkFileDialog  # using python3
 from numpy.core.multiarray import ndarray
 from roipoly import MultiRoi
+from matplotlib.path import Path as MplPath
 from math import ceil, sqrt
 from scipy.stats import linregress
 
 
+def _czi_tile(file_path, entry):
+    """
+    Return the YX data of one czi subblock. Uncompressed subblocks are memory-mapped
+    from the file instead of being read into memory.
+    :param file_path: path for the .czi file
+    :param entry: czifile DirectoryEntryDV of the subblock
+    :return: 2d np.array in the acquisition dtype
+    """
+    dtype = np.dtype(entry.dtype)
+    subblock = entry.data_segment()
+    if entry.compression or entry.stored_shape != entry.shape or dtype.shape:
+        tile = subblock.data()
+    else:
+        tile = np.memmap(file_path, dtype=dtype, mode='r', offset=subblock.data_offset,
+                         shape=entry.stored_shape)
+    return tile.reshape(tile.shape[-3:])[..., 0]
+
+
+def read_czi_channels(file_path, out=None):
+    """
+    Read the first plane of every channel from a czi file, decoding only the subblocks
+    of the first time point, z slice and scene. Mosaic tiles are pasted into place.
+    :param file_path: path for the .czi file
+    :param out: optional (C, Y, X) array to fill, e.g. a np.memmap for scans larger than RAM
+    :return: np.array (C, Y, X) in the acquisition dtype (no float upcast)
+    """
+    with czifile.CziFile(file_path) as czi:
+        axes, start, shape = czi.axes, czi.start, czi.shape
+        y_ax, x_ax = axes.index('Y'), axes.index('X')
+        c_ax = axes.index('C') if 'C' in axes else None
+        num_channel = shape[c_ax] if c_ax is not None else 1
+        if out is None:
+            out = np.zeros((num_channel, shape[y_ax], shape[x_ax]), czi.dtype)
+        for entry in czi.filtered_subblock_directory:
+            if entry.pyramid_type:
+                continue
+            if any(entry.start[i] != start[i] for i, ax in enumerate(axes) if ax not in 'CYX0'):
+                continue
+            tile = _czi_tile(file_path, entry)
+            c = entry.start[c_ax] - start[c_ax] if c_ax is not None else 0
+            y0 = entry.start[y_ax] - start[y_ax]
+            x0 = entry.start[x_ax] - start[x_ax]
+            out[c, y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] = tile
+    return out
+
+
 def load_msr(file_path=None):
-    """Loads data from the czi file. The data is in a numpy array.
+    """Loads data from the czi file. The data is in a numpy array of the acquisition dtype.
     :param file_path: path for the .czi file. Ask for a file in GUI if not provided.
     :returns: A dict with the name of the stack and the corresponding data
     """
     if not file_path:
         file_path = tkFileDialog.askopenfilename()
-    imageObj = czifile.imread(file_path)
-    numChannel = len(imageObj[0])
-    imgList = []
-    for c in range(numChannel):
-        imgList.append(imageObj[0][c][0][0].T[0])
-    imgArray = np.stack(imgList).astype('float_')
+    imgArray = read_czi_channels(file_path)
     return imgArray
 
 
@@ -102,26 +145,164 @@ def draw_roi2(multi_channel, title="Click on the button to add a new ROI"):
     return multi_roi
 
 
+def roi_label_layers(multi_roi, shape):
+    """
+    Rasterize all ROIs once into label images (0 is background, i + 1 is ROI i), testing only the
+    pixels in each bounding box. A ROI that overlaps an earlier one goes to another layer.
+    Masks are the same as roipoly's get_mask.
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :param shape: (Y, X) shape of the frame
+    :return: list of 2d int32 label images
+    """
+    (ny, nx) = shape
+    layers = []
+    for i, roi in enumerate(multi_roi.rois.values()):
+        vertices = np.column_stack((roi.x, roi.y)).astype('float64')
+        x0 = int(min(max(np.floor(vertices[:, 0].min()), 0), nx))
+        x1 = int(min(max(np.ceil(vertices[:, 0].max()) + 1, 0), nx))
+        y0 = int(min(max(np.floor(vertices[:, 1].min()), 0), ny))
+        y1 = int(min(max(np.ceil(vertices[:, 1].max()) + 1, 0), ny))
+        (x, y) = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        poly_verts = np.vstack((vertices[:1], vertices[::-1]))
+        mask = MplPath(poly_verts).contains_points(np.column_stack((x.ravel(), y.ravel())))
+        mask = mask.reshape((y1 - y0, x1 - x0))
+        for layer in layers:
+            if not layer[y0:y1, x0:x1][mask].any():
+                break
+        else:
+            layer = np.zeros(shape, dtype='int32')
+            layers.append(layer)
+        layer[y0:y1, x0:x1][mask] = i + 1
+    return layers
+
+
+def roi_signature(multi_roi):
+    """
+    Names and vertices of all ROIs, to detect that a ROI set changed
+    """
+    return tuple((name, tuple(roi.x), tuple(roi.y)) for name, roi in multi_roi.rois.items())
+
+
+def cached_label_layers(multi_roi, shape):
+    """
+    `roi_label_layers` cached on the ROI object (`_mask_cache`) per frame shape, so that measuring the
+    same ROIs on several stacks (corrected, raw) rasterizes them once. The cache entry is rebuilt
+    when ROIs are added, removed or moved.
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :param shape: (Y, X) shape of the frame
+    :return: list of raveled label layers, 1d int32 np.array of Y * X pixels (0 is background,
+             i + 1 is ROI i), one per layer of `roi_label_layers`
+    """
+    shape = tuple(int(i) for i in shape)
+    signature = roi_signature(multi_roi)
+    cache = getattr(multi_roi, '_mask_cache', None)
+    if cache is None:
+        cache = {}
+        multi_roi._mask_cache = cache
+    entry = cache.get(shape)
+    if entry is None or entry[0] != signature:
+        entry = (signature, [layer.ravel() for layer in roi_label_layers(multi_roi, shape)])
+        cache[shape] = entry
+    return entry[1]
+
+
 def get_intensity_list(multi_roi, multi_channel):
-    all_list = []
+    """
+    Get the mean intensity of ROIs. ROIs are rasterized once per frame shape (`cached_label_layers`)
+    and measured in all channels with np.bincount.
+    :param multi_roi: ROI object obtained from `draw_roi2`
+    :param multi_channel: 3d np.array image stack
+    :return: np.array (C, ROI), zeros (C) without ROIs
+    """
     if len(multi_roi.rois):
-        for channel in multi_channel:
-            channel_list = np.array([])
-            for name, roi in multi_roi.rois.items():
-                mean, std = roi.get_mean_and_std(channel)
-                # print(mean)
-                channel_list = np.append(channel_list, mean)
-            all_list.append(channel_list)
-        final_list = np.stack(all_list)  # type: ndarray
-        return final_list
+        num_roi = len(multi_roi.rois)
+        labels = cached_label_layers(multi_roi, multi_channel.shape[-2:])
+        count = sum(np.bincount(lab, minlength=num_roi + 1)[1:] for lab in labels)
+        final_list = np.zeros((len(multi_channel), num_roi))  # type: ndarray
+        for c, channel in enumerate(multi_channel):
+            for lab in labels:
+                final_list[c] += np.bincount(lab, weights=channel.ravel(), minlength=num_roi + 1)[1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return final_list / count
     else:
         return np.zeros(len(multi_channel))
 
 
+class polygonRoi():
+    """
+    polygonRoi is a polygon ROI without GUI, with the geometry and display methods of roipoly's RoiPoly.
+    """
+
+    def __init__(self, x, y, color='b'):
+        self.x = list(x)
+        self.y = list(y)
+        self.color = color
+
+    def get_mask(self, current_image):
+        return roi_label_layers(roiSet([('0', self)]), np.shape(current_image))[0] > 0
+
+    def get_mean_and_std(self, current_image):
+        values = np.asarray(current_image)[self.get_mask(current_image)]
+        return np.mean(values), np.std(values)
+
+    def display_roi(self, **linekwargs):
+        line = plt.Line2D(self.x + [self.x[0]], self.y + [self.y[0]], color=self.color, **linekwargs)
+        ax = plt.gca()
+        ax.add_line(line)
+        plt.draw()
+
+    def display_mean(self, current_image, **textkwargs):
+        mean, std = self.get_mean_and_std(current_image)
+        string = "%.3f +- %.3f" % (mean, std)
+        plt.text(self.x[0], self.y[0], string, color=self.color,
+                 bbox=dict(facecolor='w', alpha=0.6), **textkwargs)
+
+
+class roiSet():
+    """
+    roiSet is a set of named polygonRoi that can be used wherever a MultiRoi from `draw_roi2` is
+    expected (`.rois` dict), without GUI. Rasterized masks are cached per frame shape, see `cached_label_layers`.
+    """
+
+    def __init__(self, rois=None):
+        """
+        :param rois: dict or list of (name, polygonRoi)
+        """
+        self.rois = dict(rois or {})
+        self._mask_cache = {}
+
+
+def save_rois(file_path, multi_roi):
+    """
+    Save the polygons of ROIs to a compressed .npz file, in the format of Leica_SP8/roi_measure.py
+    :param file_path: path of the .npz file
+    :param multi_roi: ROI object obtained from `draw_roi2`, or a roiSet
+    :return: file_path
+    """
+    rois = list(multi_roi.rois.items())
+    polygons = [np.column_stack((roi.x, roi.y)).astype('float64').reshape(-1, 2) for name, roi in rois]
+    np.savez_compressed(file_path, names=np.array([str(name) for name, roi in rois], dtype=str),
+                        colors=np.array([str(getattr(roi, 'color', 'b')) for name, roi in rois], dtype=str),
+                        num_vertex=np.array([len(vertices) for vertices in polygons], dtype='int64'),
+                        vertices=np.concatenate(polygons) if polygons else np.zeros((0, 2)))
+    return file_path
+
+
+def load_rois(file_path):
+    """
+    Load ROIs saved by `save_rois`
+    :param file_path: path of the .npz file
+    :return: roiSet, usable in get_intensity_list and show_all_channels_with_roi
+    """
+    with np.load(file_path) as data:
+        polygons = np.split(data['vertices'], np.cumsum(data['num_vertex'])[:-1])
+        return roiSet((str(name), polygonRoi(vertices[:, 0], vertices[:, 1], str(color)))
+                      for name, color, vertices in zip(data['names'], data['colors'], polygons))
+
+
 def subtract_background(multi_channel, bg_mean_list):
-    subtracted = multi_channel.copy()
-    for i in range(len(multi_channel)):
-        subtracted[i] = multi_channel[i] - bg_mean_list[i]
+    # float32 result so that unsigned raw data from load_msr cannot wrap around below 0
+    subtracted = np.subtract(multi_channel, np.reshape(bg_mean_list, (-1, 1, 1)), dtype='float32')
     return subtracted
 
 
@@ -171,64 +352,194 @@ def show_all_channels_with_roi2(multi_channel, multi_roi):
     return 0
 
 
-def get_slope(roi_list):
+def _slope_rsq(sxy, sy, num):
     """
-    calculate the bleed-through coefficient by linear regression, y-intercept fixed at 0
-    :param roi_list: intensity list generated by get_intensity_list
-    :return: array of slopes, array of standard deviation
+    Through-origin slopes and R^2 of all channel pairs from sufficient statistics
+    :param sxy: (..., C, C) sums of x_i * x_j over ROIs
+    :param sy: (..., C) sums of x_j over ROIs
+    :param num: number of ROIs
+    :return: slope (..., C, C), rsq (..., C, C); [i, j] regresses channel j on channel i
+    """
+    sxx = np.diagonal(sxy, axis1=-2, axis2=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx[..., :, np.newaxis]
+        # residual sum of squares of y = slope * x: Syy - Sxy^2 / Sxx
+        sse = sxx[..., np.newaxis, :] - sxy * slope
+        sst = sxx - sy ** 2 / num
+        rsq = 1 - sse / sst[..., np.newaxis, :]
+    return slope, rsq
+
+
+def get_slope(roi_list, verbose=True):
+    """
+    calculate the bleed-through coefficient by linear regression, y-intercept fixed at 0,
+    for all channel pairs at once from the sums of products over ROIs
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param verbose: print the coefficients of every channel pair
+    :return: array of slopes, array of r-squared; [i][j] is from channel i to channel j
     """
-    num_channel = len(roi_list)
-    slope_array = np.zeros([num_channel, num_channel])
-    rsq_array = np.zeros([num_channel, num_channel])
-    for i in range(num_channel):
-        for j in range(num_channel):
-            # reg = linregress(roi_list[i], roi_list[j])
-            # slope = reg.slope
-            # rsq = reg.rvalue
-            x = roi_list[i][:, np.newaxis]
-            y = roi_list[j]
-            slope, SSE, _, _, = np.linalg.lstsq(x, y, rcond=None)
-            rsq = 1 - (SSE / ((y ** 2).sum() - (len(y) * (y.mean()) ** 2)))
-            slope_array[i][j] = float(slope)
-            rsq_array[i][j] = float(rsq)
-            if i != j:
-                print("Channel", i + 1, "to Channel", j + 1, slope, rsq)
+    x = np.asarray(roi_list, dtype='float64')
+    (slope_array, rsq_array) = _slope_rsq(x @ x.T, x.sum(axis=1), x.shape[1])
+    if verbose:
+        for (i, j) in zip(*np.nonzero(~np.eye(len(x), dtype=bool))):
+            print("Channel", i + 1, "to Channel", j + 1, slope_array[i, j], rsq_array[i, j])
     return slope_array, rsq_array
 
 
-def get_coefficient(roi_list):
+def get_coefficient(roi_list, verbose=True):
     """
     calculate the bleed-through coefficient by averaging the ratio
-    :param roi_list: intensity list generated by get_intensity_list
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param verbose: print the coefficients of every channel pair
     :return: array of slopes, array of standard deviation
     """
-    num_channel = len(roi_list)
-    slope_array = np.zeros([num_channel, num_channel])
-    std_array = np.zeros([num_channel, num_channel])
-    for i in range(num_channel):
-        for j in range(num_channel):
-            # reg = linregress(roi_list[i], roi_list[j])
-            slp = roi_list[j] / roi_list[i]
-            slope = slp.mean()
-            sd = slp.std()
-            slope_array[i][j] = slope
-            std_array[i][j] = sd
-            if i != j:
-                print("Channel", i + 1, "to Channel", j + 1, slope, sd)
+    x = np.asarray(roi_list, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = x[np.newaxis, :, :] / x[:, np.newaxis, :]
+    (slope_array, std_array) = (ratio.mean(axis=2), ratio.std(axis=2))
+    if verbose:
+        for (i, j) in zip(*np.nonzero(~np.eye(len(x), dtype=bool))):
+            print("Channel", i + 1, "to Channel", j + 1, slope_array[i, j], std_array[i, j])
     return slope_array, std_array
 
 
-def subtract_bt(multi_channel, bt_array):
-    num_channel = len(multi_channel)
-    new_list = []
-    for j in range(num_channel):
-        temp = multi_channel[j].copy()
-        for i in range(num_channel):
-            if i != j:
-                temp = temp - bt_array[i][j] * multi_channel[i]
-        new_list.append(temp)
-    new_stack = np.stack(new_list)
-    return new_stack
+def bootstrap_coefficients(roi_list, method='slope', num_boot=1000, ci=95, seed=None, chunk_size=100):
+    """
+    Bootstrap over ROIs: confidence intervals of the bleed-through coefficients of all channel pairs.
+    Every resample is a weighting of the ROIs (how often each ROI is drawn), so all pairs of all
+    resamples come from one matrix product with the per-ROI products.
+    :param roi_list: intensity list generated by get_intensity_list, (C, ROI)
+    :param method: 'slope' as `get_slope`, or 'ratio' as `get_coefficient`
+    :param num_boot: number of resamples
+    :param ci: confidence level in percent
+    :param seed: seed of the random generator
+    :param chunk_size: number of resamples computed together
+    :return: coefficients (C, C), lower bounds (C, C), upper bounds (C, C)
+    """
+    x = np.asarray(roi_list, dtype='float64')
+    (num_channel, num) = x.shape
+    if method == 'slope':
+        # per-ROI products x_i * x_j and values x_j
+        terms = np.concatenate(((x[:, np.newaxis, :] * x[np.newaxis, :, :]).reshape(-1, num), x))
+        estimate = get_slope(x, verbose=False)[0]
+    elif method == 'ratio':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = (x[np.newaxis, :, :] / x[:, np.newaxis, :]).reshape(-1, num)
+        estimate = get_coefficient(x, verbose=False)[0]
+    else:
+        raise ValueError("method has to be 'slope' or 'ratio'")
+    rng = np.random.default_rng(seed)
+    samples = []
+    for start in range(0, num_boot, chunk_size):
+        size = min(chunk_size, num_boot - start)
+        draws = rng.integers(0, num, (size, num)) + np.arange(size)[:, np.newaxis] * num
+        weights = np.bincount(draws.ravel(), minlength=size * num).reshape(size, num).astype('float64')
+        sums = weights @ terms.T
+        if method == 'slope':
+            sxy = sums[:, :num_channel ** 2].reshape(size, num_channel, num_channel)
+            samples.append(_slope_rsq(sxy, sums[:, num_channel ** 2:], num)[0])
+        else:
+            samples.append(sums.reshape(size, num_channel, num_channel) / num)
+    samples = np.concatenate(samples)
+    (low, high) = np.nanpercentile(samples, [(100 - ci) / 2., (100 + ci) / 2.], axis=0)
+    return estimate, low, high
+
+
+def bt_correction_matrix(bt_array, num_channel=None):
+    """
+    Matrix M so that the corrected channels are M @ channels: 1 on the diagonal and -bt_array[i][j]
+    at [j, i], i.e. channel j - sum over i != j of bt_array[i][j] * channel i.
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param num_channel: number of channels of the image. Only the top-left block of bt_array is used,
+                        so a matrix for more channels (e.g. the 4x4 defaults) works on fewer.
+    :return: (C, C) float32 np.array
+    """
+    matrix = -np.array(bt_array, dtype='float32')[:num_channel, :num_channel].T
+    np.fill_diagonal(matrix, 1)
+    return matrix
+
+
+def _apply_channel_matrix(multi_channel, matrix, out=None, clip=False, block_size=65536):
+    """
+    out = matrix @ channels for every pixel, one frame and one block of pixels at a time
+    """
+    if out is None:
+        out = np.empty(multi_channel.shape, dtype='float32')
+    if len(multi_channel.shape) == 3:
+        (frames, out_frames) = (np.asarray(multi_channel)[np.newaxis], out[np.newaxis])
+    else:
+        (frames, out_frames) = (multi_channel, out)
+    num_channel = frames.shape[1]
+    size = frames.shape[2] * frames.shape[3]
+    buffer = np.empty((num_channel, min(block_size, size)), dtype='float32')
+    for t in range(len(frames)):
+        frame = np.asarray(frames[t]).reshape(num_channel, size)
+        target = out_frames[t]
+        if not target.flags.c_contiguous:
+            raise ValueError("out has to be C-contiguous")
+        target = target.reshape(num_channel, size)
+        for start in range(0, size, block_size):
+            block = slice(start, start + block_size)
+            result = buffer[:, :min(block_size, size - start)]
+            np.matmul(matrix, frame[:, block], out=result)
+            if clip:
+                np.maximum(result, 0, out=result)
+            target[:, block] = result
+    return out
+
+
+def subtract_bt(multi_channel, bt_array, out=None, block_size=65536):
+    """
+    Subtract bleed-through as one contraction over the channel axis, one frame and one block of
+    pixels at a time, so that only a small float32 buffer is allocated.
+    :param multi_channel: np.array, CYX or TCYX
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param out: optional C-contiguous array of the same shape to write into, e.g. multi_channel itself
+                (float) for in-place correction
+    :param block_size: number of pixels per block
+    :return: float32 np.array (or out)
+    """
+    matrix = bt_correction_matrix(bt_array, multi_channel.shape[-3])
+    return _apply_channel_matrix(multi_channel, matrix, out, False, block_size)
+
+
+def unmixing_matrix(bt_array, num_channel=None):
+    """
+    Exact unmixing: the inverse of the full mixing matrix, where measured channel j is
+    true channel j + sum over i != j of bt_array[i][j] * true channel i. Computed once per matrix;
+    a singular mixing matrix gets its pseudo-inverse.
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param num_channel: number of channels of the image, only the top-left block of bt_array is used
+    :return: (C, C) float32 np.array, true channels = matrix @ measured channels
+    """
+    key = np.ascontiguousarray(np.array(bt_array, dtype='float64')[:num_channel, :num_channel])
+    return _unmixing_matrix(key.tobytes(), key.shape).copy()
+
+
+@lru_cache(maxsize=32)
+def _unmixing_matrix(data, shape):
+    mixing = np.frombuffer(data).reshape(shape).T.copy()
+    np.fill_diagonal(mixing, 1)
+    if np.linalg.matrix_rank(mixing) < len(mixing):
+        return np.linalg.pinv(mixing).astype('float32')
+    return np.linalg.inv(mixing).astype('float32')
+
+
+def unmix(multi_channel, bt_array, out=None, clip=False, block_size=65536):
+    """
+    Remove bleed-through exactly, by applying the inverse mixing matrix (see `unmixing_matrix`) to
+    every pixel. `subtract_bt` is the first-order approximation, which subtracts bleed-through
+    estimated from the uncorrected channels. Same cost as `subtract_bt`.
+    :param multi_channel: np.array, CYX or TCYX
+    :param bt_array: bleed-through matrix, bt_array[i][j] is the bleed-through of channel i into channel j
+    :param out: optional C-contiguous array of the same shape to write into, e.g. multi_channel itself
+                (float) for in-place unmixing
+    :param clip: clip negative values at 0
+    :param block_size: number of pixels per block
+    :return: float32 np.array (or out)
+    """
+    matrix = unmixing_matrix(bt_array, multi_channel.shape[-3])
+    return _apply_channel_matrix(multi_channel, matrix, out, clip, block_size)
 
 
 class BleedThroughChart(tk.Frame):
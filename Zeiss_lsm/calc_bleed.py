@@ -10,11 +10,22 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 
 from bleedthrough import *
 
+######################## User defined parameters ###################
+# ROI sets saved by an earlier run, None to draw the ROIs
+BgRoiFile = None        # e.g. "bg_rois.npz"
+CellRoiFile = None      # e.g. "cell_rois.npz"
+
+######################### Don't change after this line
+
 # Read czi file
 rawImg = load_msr()
 
 # Define ROIs for the background
-bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+if BgRoiFile:
+    bg_rois = load_rois(BgRoiFile)
+else:
+    bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+save_rois("bg_rois.npz", bg_rois)
 bg_list = get_intensity_list(bg_rois, rawImg)
 try:
     bg_mean = np.mean(bg_list, axis=1)
@@ -29,10 +40,17 @@ newImg[newImg < 0] = 0
 # show_all_channels_with_roi(newImg, bg_rois)
 
 # Define ROIs with cells
-cell_rois = draw_roi2(newImg)
+if CellRoiFile:
+    cell_rois = load_rois(CellRoiFile)
+else:
+    cell_rois = draw_roi2(newImg)
+save_rois("cell_rois.npz", cell_rois)
 cell_list = get_intensity_list(cell_rois, newImg)
 print("cell ROI values are:\n", cell_list)
 show_all_channels_with_roi2(newImg, cell_rois)
 slopes, rsqs = get_slope(cell_list)
 print("slope\t from {rows} | to {columns} \n", slopes)
-print("r-value\t from {rows} | to {columns} \n", rsqs)
\ No newline at end of file
+print("r-value\t from {rows} | to {columns} \n", rsqs)
+(_, slope_low, slope_high) = bootstrap_coefficients(cell_list)
+print("95% confidence interval of the slopes, lower bound\n", slope_low)
+print("95% confidence interval of the slopes, upper bound\n", slope_high)
\ No newline at end of file
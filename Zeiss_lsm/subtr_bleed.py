@@ -11,11 +11,21 @@ required packages: matplotlib, numpy, scipy, czifile, roipoly, tifffile
 from bleedthrough import *
 import tifffile
 
+######################## User defined parameters ###################
+# ROI sets saved by an earlier run, None to draw the ROIs
+BgRoiFile = None        # e.g. "bg_rois.npz"
+
+######################### Don't change after this line
+
 # Read czi file
 rawImg = load_msr()
 
 # Define ROIs for the background
-bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+if BgRoiFile:
+    bg_rois = load_rois(BgRoiFile)
+else:
+    bg_rois = draw_roi2(rawImg, title="Please define ROIs for the background.")
+save_rois("bg_rois.npz", bg_rois)
 bg_list = get_intensity_list(bg_rois, rawImg)
 try:
     bg_mean = np.mean(bg_list, axis=1)